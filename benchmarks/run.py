@@ -0,0 +1,294 @@
+import os
+import sys
+import json
+import asyncio
+import argparse
+import platform
+import statistics
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, List
+
+# --- Microbenchmarks ---
+# Times the server's hot paths in-process:
+#   python benchmarks/run.py                 # compare against benchmarks/baseline.json
+#   python benchmarks/run.py --save          # record a new baseline
+#   python benchmarks/run.py --filter history
+# Each benchmark is run in batches of calls (sized so a batch takes at least
+# --min-time seconds) and reported as the median time per call. A benchmark
+# more than --threshold slower than its baseline is flagged and the exit
+# status is 1. Baselines only compare well on the machine that recorded them.
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE_PATH = os.path.join(ROOT, "benchmarks", "baseline.json")
+sys.path.insert(0, ROOT)
+
+# The benchmarks create and delete teams, so they get a throwaway SQLite file
+# whatever DATABASE_URL is configured. Both URLs are set explicitly: load_dotenv
+# keeps existing variables, but database.py would derive the async URL from
+# DATABASE_URL only if ASYNC_DATABASE_URL were empty.
+BENCH_DIR = tempfile.mkdtemp(prefix="escape-room-bench-")
+BENCH_DB = os.path.join(BENCH_DIR, "bench.db")
+os.environ["DATABASE_URL"] = f"sqlite:///{BENCH_DB}"
+os.environ["ASYNC_DATABASE_URL"] = f"sqlite+aiosqlite:///{BENCH_DB}"
+os.chdir(BENCH_DIR)
+os.environ.setdefault("LLM_PROVIDER", "fake")
+
+from pydantic import TypeAdapter
+from sqlalchemy import delete
+from starlette.requests import Request
+from starlette.responses import Response
+
+import main
+from chat_journal import ChatJournal
+from context_window import ContextWindow, token_budget, history_page
+from database import AsyncSessionLocal, Team, InventoryItem, ChatHistory
+
+BENCHMARKS: Dict[str, Callable] = {}
+
+
+def benchmark(name: str):
+    """Registers an async setup function that returns the (sync or async) callable to time."""
+    def register(setup):
+        BENCHMARKS[name] = setup
+        return setup
+    return register
+
+
+# --- Fixtures ---
+
+INVENTORY = [("BigQuery Keycard", "💳"), ("Corporate Credit Card", "💳"), ("Flat Rate Shield", "🛡️")]
+
+GAME_STATE = {
+    "current_room": "snowflake-room",
+    "books_has_dropped_key": True,
+    "terminal_stage": "UNLOCKED",
+    "fire_has_card": False,
+    "collected_letters": ["E"],
+    "latest_letter": "E",
+}
+
+TAGGED_REPLY = (
+    "SELECTION CONFIRMED. The machine whirs, dispensing a glowing shield... "
+    "[STATE_UPDATE: snowman_stopped=true] [STATE_UPDATE: credits_burned=1250] "
+    "[STATE_UPDATE: yeti_mood='calm'] [ADD_ITEM: name=\"Flat Rate Shield\" icon=\"🛡️\"] "
+    "The counter finally stops spinning. [ADD_ITEM: name=\"Usage Report\" icon=\"📈\"] "
+    "[STATE_UPDATE: room_completed=true]"
+)
+
+PLAIN_REPLY = (
+    "The Auto-Scaler Snowman grows another ten feet and bellows about elastic compute. "
+    "Somewhere behind it, the credit counter ticks upward again."
+)
+
+
+async def create_team(name: str, game_state: dict = GAME_STATE, inventory=INVENTORY) -> int:
+    async with AsyncSessionLocal() as db:
+        team = Team(name=name, game_state=dict(game_state))
+        db.add(team)
+        await db.flush()
+        db.add_all(InventoryItem(name=n, icon=i, team_id=team.id) for n, i in inventory)
+        await db.commit()
+        return team.id
+
+
+async def load_snapshot(team_id: int):
+    async with AsyncSessionLocal() as db:
+        return await main.team_cache.get(db, team_id)
+
+
+# --- Benchmarks ---
+
+def register_process_ai_response(label: str, reply: str):
+    @benchmark(f"process_ai_response[{label}]")
+    async def setup():
+        team_id = await create_team(f"bench-process-{label}")
+        team = await load_snapshot(team_id)
+
+        async def run():
+            # Rolled back on close, like a turn that never commits
+            async with AsyncSessionLocal() as db:
+                await main.process_ai_response(reply, team.copy(), "data_marketplace", db, "snowflake-room")
+        return run
+
+
+register_process_ai_response("tags", TAGGED_REPLY)
+register_process_ai_response("plain", PLAIN_REPLY)
+
+
+@benchmark("award_letter")
+async def setup_award_letter():
+    team = await load_snapshot(await create_team("bench-award"))
+
+    def run():
+        team.game_state = {**GAME_STATE, "collected_letters": ["E"]}
+        main.award_letter(team, "snowflake-room")
+    return run
+
+
+def register_history(size: int):
+    @benchmark(f"history_reconstruction[{size}]")
+    async def setup():
+        team_id = await create_team(f"bench-history-{size}")
+        start = datetime.now(timezone.utc) - timedelta(hours=1)
+        async with AsyncSessionLocal() as db:
+            db.add_all(
+                ChatHistory(
+                    team_id=team_id, item_id="sparky",
+                    role="user" if i % 2 == 0 else "model",
+                    content=f"Message {i}: " + "The cluster is still warming up, try again. " * 4,
+                    timestamp=start + timedelta(seconds=i)
+                )
+                for i in range(size)
+            )
+            await db.commit()
+        journal = ChatJournal(AsyncSessionLocal)
+        budget = token_budget(main.ROOM_CONFIGS["databricks-room"], "sparky")
+
+        async def run():
+            # What a socket does on connect: model history plus the client's first page
+            async with AsyncSessionLocal() as db:
+                context = await ContextWindow.load(db, journal, team_id, "sparky", budget)
+                context.history()
+                await history_page(db, journal, team_id, "sparky")
+        return run
+
+
+for _size in (10, 100, 1000):
+    register_history(_size)
+
+
+def register_teams(size: int):
+    @benchmark(f"get_teams[{size}]")
+    async def setup():
+        async with AsyncSessionLocal() as db:
+            await db.execute(delete(InventoryItem))
+            await db.execute(delete(Team))
+            await db.commit()
+        for i in range(size):
+            await create_team(f"bench-team-{i}")
+        adapter = TypeAdapter(List[main.TeamInfo])
+        request = Request({"type": "http", "method": "GET", "path": "/teams", "headers": []})
+
+        async def run():
+            # Query plus the response_model validation and JSON encoding FastAPI does
+            async with AsyncSessionLocal() as db:
+                teams = await main.get_teams(request, Response(), db=db)
+            adapter.dump_json(adapter.validate_python(teams, from_attributes=True))
+        return run
+
+
+for _size in (10, 100, 1000):
+    register_teams(_size)
+
+
+def register_prompts(room_id: str):
+    @benchmark(f"render_prompts[{room_id}]")
+    async def setup():
+        team = await load_snapshot(await create_team(f"bench-prompts-{room_id}", {**GAME_STATE, "current_room": room_id}))
+        room_conf = main.ROOM_CONFIGS[room_id]
+        item_ids = ["coordinator", *room_conf.get("items", {})]
+
+        def run():
+            for item_id in item_ids:
+                main.render_system_instruction(team, room_id, room_conf, item_id)
+        return run
+
+
+for _room_id in ("databricks-room", "snowflake-room", "microsoft-room"):
+    register_prompts(_room_id)
+
+
+# --- Runner ---
+
+async def time_batch(func: Callable, loops: int) -> float:
+    if asyncio.iscoroutinefunction(func):
+        started = time.perf_counter()
+        for _ in range(loops):
+            await func()
+    else:
+        started = time.perf_counter()
+        for _ in range(loops):
+            func()
+    return time.perf_counter() - started
+
+
+async def measure(func: Callable, min_time: float, repeats: int) -> dict:
+    # Double the batch size until one batch takes long enough to time reliably
+    loops = 1
+    while (elapsed := await time_batch(func, loops)) < min_time:
+        loops *= 2
+    per_call = [elapsed / loops]
+    for _ in range(repeats - 1):
+        per_call.append(await time_batch(func, loops) / loops)
+    return {"median": statistics.median(per_call), "min": min(per_call), "loops": loops}
+
+
+def format_seconds(seconds: float) -> str:
+    if seconds >= 1e-3:
+        return f"{seconds * 1e3:.2f} ms"
+    return f"{seconds * 1e6:.1f} µs"
+
+
+async def run_benchmarks(args) -> Dict[str, dict]:
+    results = {}
+    for name, setup in BENCHMARKS.items():
+        if args.filter and args.filter not in name:
+            continue
+        func = await setup()
+        results[name] = await measure(func, args.min_time, args.repeats)
+    return results
+
+
+def report(results: Dict[str, dict], baseline: Dict[str, dict], threshold: float) -> List[str]:
+    """Prints one line per benchmark and returns the names that regressed."""
+    regressions = []
+    width = max(len(name) for name in results)
+    for name, result in results.items():
+        line = f"{name:<{width}}  {format_seconds(result['median']):>10}"
+        if name in baseline:
+            change = result["median"] / baseline[name]["median"] - 1
+            line += f"  baseline {format_seconds(baseline[name]['median']):>10}  {change:+7.1%}"
+            if change > threshold:
+                line += "  REGRESSION"
+                regressions.append(name)
+        print(line)
+    return regressions
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Microbenchmarks for the escape room backend.")
+    parser.add_argument("--filter", help="Only run benchmarks whose name contains this text")
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="Baseline file to compare against / save to")
+    parser.add_argument("--save", action="store_true", help="Save the results as the new baseline")
+    parser.add_argument("--threshold", type=float, default=0.2, help="Slowdown that counts as a regression (0.2 = 20%%)")
+    parser.add_argument("--min-time", type=float, default=0.2, help="Minimum duration of one timed batch (seconds)")
+    parser.add_argument("--repeats", type=int, default=5, help="Timed batches per benchmark")
+    args = parser.parse_args()
+
+    results = asyncio.run(run_benchmarks(args))
+
+    baseline = {}
+    if not args.save and os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+    regressions = report(results, baseline, args.threshold)
+
+    if args.save:
+        with open(args.baseline, "w") as f:
+            json.dump({
+                "recorded": datetime.now(timezone.utc).isoformat(),
+                "python": platform.python_version(),
+                "machine": platform.platform(),
+                "results": results,
+            }, f, indent=2)
+            f.write("\n")
+        print(f"Baseline saved to {args.baseline}")
+    elif regressions:
+        print(f"{len(regressions)} benchmark(s) regressed by more than {args.threshold:.0%}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main_cli()
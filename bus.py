@@ -0,0 +1,203 @@
+import os
+import json
+import uuid
+import asyncio
+import socket
+from typing import Awaitable, Callable, Optional, Set
+
+from sqlalchemy import delete, insert, select
+
+from database import TeamEvent
+
+# --- Team Change Bus ---
+# Each worker (uvicorn --workers N, or another host sharing the database)
+# keeps its own TeamStateCache and Leaderboard. After committing a change to
+# a team, a worker publishes the team id here; the other workers drop their
+# cached copy, refresh their leaderboard and, if asked, discard chat rows
+# still buffered in their ChatJournal. Writes themselves stay safe without
+# the bus (teams.state_version is compared-and-set); the bus keeps reads fresh.
+# A turn also announces the item it added chat rows to, so the sockets other
+# workers have open on that item reload the conversation (see sessions.py).
+#
+# TEAM_BUS picks the transport:
+#   "local" (default) single process, nothing to tell anyone
+#   "db"    a team_events table in the shared database, polled every
+#           TEAM_BUS_POLL_INTERVAL seconds; needs no extra service, so it
+#           suits several workers on one host sharing game.db
+#   "redis" pub/sub on a Redis-compatible server at REDIS_URL (needs the
+#           optional `redis` package)
+
+POLL_INTERVAL = float(os.getenv("TEAM_BUS_POLL_INTERVAL", "0.2"))
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+CHANNEL = os.getenv("TEAM_BUS_CHANNEL", "escape-room:teams")
+# team_events rows kept behind the newest one a worker has seen
+EVENT_RETENTION = 10000
+
+# Identifies this process, so a worker ignores its own events
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+# handler(team_id, deleted, discard, chat)
+Handler = Callable[[int, bool, Optional[str], Optional[str]], Awaitable[None]]
+
+
+class LocalBus:
+    """Single-process deployments: there is no one else to notify."""
+    name = "local"
+
+    async def start(self, handler: Handler):
+        pass
+
+    def publish(self, team_id: int, deleted: bool = False, discard: Optional[str] = None, chat: Optional[str] = None):
+        """Announces a committed change to a team.
+
+        `discard` names the chat buffer to drop ("*" for all); `chat` names the
+        item whose conversation got new rows (already in the database).
+        """
+        pass
+
+    async def close(self):
+        pass
+
+    async def _deliver(self, team_id: int, deleted: bool, discard: Optional[str], chat: Optional[str]):
+        try:
+            await self._handler(team_id, deleted, discard, chat)
+        except Exception as e:
+            print(f"Team bus error (team {team_id}): {e}")
+
+
+class DatabaseBus(LocalBus):
+    """Events go through the team_events table, polled by every worker."""
+    name = "db"
+
+    # Rows are re-read this far behind the newest id seen, so an event whose
+    # id was handed out earlier but committed later (server databases) isn't skipped
+    LOOKBACK = 64
+
+    def __init__(self, session_factory, interval: float = POLL_INTERVAL):
+        self._session_factory = session_factory
+        self._interval = interval
+        self._outbox = []
+        self._seen: Set[int] = set()
+        self._last_id = 0
+        self._handler: Optional[Handler] = None
+        self._task: Optional[asyncio.Task] = None
+        self._polls = 0
+
+    async def start(self, handler: Handler):
+        self._handler = handler
+        self._wakeup = asyncio.Event()
+        async with self._session_factory() as db:
+            self._last_id = await db.scalar(select(TeamEvent.id).order_by(TeamEvent.id.desc()).limit(1)) or 0
+        self._task = asyncio.create_task(self._run())
+
+    def publish(self, team_id: int, deleted: bool = False, discard: Optional[str] = None, chat: Optional[str] = None):
+        self._outbox.append({"team_id": team_id, "origin": WORKER_ID, "deleted": deleted, "discard": discard, "chat": chat})
+        if self._task:
+            self._wakeup.set()
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        # Whatever is still queued goes out before the worker stops
+        if self._outbox:
+            await self._poll(deliver=False)
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self._interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self._poll()
+            except Exception as e:
+                print(f"Team bus error: {e}")
+
+    async def _poll(self, deliver: bool = True):
+        async with self._session_factory() as db:
+            if self._outbox:
+                batch, self._outbox = self._outbox, []
+                await db.execute(insert(TeamEvent), batch)
+            rows = []
+            if deliver:
+                rows = (await db.scalars(
+                    select(TeamEvent).where(TeamEvent.id > self._last_id - self.LOOKBACK).order_by(TeamEvent.id)
+                )).all()
+            self._polls += 1
+            if self._polls % 500 == 0:
+                # Every worker prunes now and then; the oldest rows are long delivered
+                await db.execute(delete(TeamEvent).where(TeamEvent.id <= self._last_id - EVENT_RETENTION))
+            await db.commit()
+
+        for row in rows:
+            if row.id in self._seen:
+                continue
+            self._seen.add(row.id)
+            self._last_id = max(self._last_id, row.id)
+            if row.origin != WORKER_ID:
+                await self._deliver(row.team_id, row.deleted, row.discard, row.chat)
+        self._seen = {i for i in self._seen if i > self._last_id - self.LOOKBACK}
+
+
+class RedisBus(LocalBus):
+    """Events go through Redis pub/sub; delivery is immediate instead of polled."""
+    name = "redis"
+
+    def __init__(self, url: str = REDIS_URL, channel: str = CHANNEL):
+        import redis.asyncio as redis
+        self._redis = redis.from_url(url)
+        self._channel = channel
+        self._handler: Optional[Handler] = None
+        self._task: Optional[asyncio.Task] = None
+        self._sending: Set[asyncio.Task] = set()
+
+    async def start(self, handler: Handler):
+        self._handler = handler
+        self._pubsub = self._redis.pubsub()
+        await self._pubsub.subscribe(self._channel)
+        self._task = asyncio.create_task(self._run())
+
+    def publish(self, team_id: int, deleted: bool = False, discard: Optional[str] = None, chat: Optional[str] = None):
+        message = json.dumps({"team_id": team_id, "origin": WORKER_ID, "deleted": deleted, "discard": discard, "chat": chat})
+        task = asyncio.create_task(self._redis.publish(self._channel, message))
+        # Keep a reference until sent (the loop only holds weak ones)
+        self._sending.add(task)
+        task.add_done_callback(self._sending.discard)
+
+    async def close(self):
+        if self._sending:
+            await asyncio.gather(*self._sending, return_exceptions=True)
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        await self._pubsub.unsubscribe(self._channel)
+        await self._redis.aclose()
+
+    async def _run(self):
+        async for message in self._pubsub.listen():
+            if message.get("type") != "message":
+                continue
+            event = json.loads(message["data"])
+            if event["origin"] != WORKER_ID:
+                await self._deliver(event["team_id"], event["deleted"], event["discard"], event.get("chat"))
+
+
+def create_bus(session_factory):
+    """The bus selected by TEAM_BUS."""
+    name = os.getenv("TEAM_BUS", "local").lower()
+    if name == "local":
+        return LocalBus()
+    if name == "db":
+        return DatabaseBus(session_factory)
+    if name == "redis":
+        return RedisBus()
+    raise ValueError(f"Unknown TEAM_BUS '{name}' (expected local, db or redis)")
@@ -0,0 +1,152 @@
+import os
+import asyncio
+from datetime import datetime
+from typing import List, Optional
+
+from sqlalchemy import insert, select
+
+from database import ChatHistory, to_naive_utc
+
+FLUSH_INTERVAL = float(os.getenv("CHAT_JOURNAL_FLUSH_INTERVAL", "0.05"))
+MAX_BATCH = int(os.getenv("CHAT_JOURNAL_MAX_BATCH", "256"))
+
+
+class ChatJournal:
+    """Write-behind buffer for ChatHistory rows.
+
+    Turns append rows here instead of committing them one by one; a background
+    task group-commits whatever has accumulated every FLUSH_INTERVAL seconds (or
+    as soon as MAX_BATCH rows are waiting), so SQLite pays one fsync per batch.
+
+    Rows stay visible through `history()` until their batch is committed, and
+    `history()` holds the flush lock, so a history load never misses a row that
+    is halfway between the buffer and the table.
+    """
+
+    def __init__(self, session_factory, flush_interval: float = FLUSH_INTERVAL, max_batch: int = MAX_BATCH):
+        self._session_factory = session_factory
+        self._flush_interval = flush_interval
+        self._max_batch = max_batch
+        self._pending: List[dict] = []
+        self._lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._full = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        # Fresh primitives bound to the loop that is serving the app
+        self._lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._full = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        """Stops the background task and writes out everything still buffered."""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        while self._pending and await self.flush():
+            pass
+
+    def append(self, team_id: int, item_id: str, role: str, content: str) -> ChatHistory:
+        """Buffers a chat row and returns it as a transient ChatHistory."""
+        # Timestamp is taken now (not at flush) so history keeps turn order
+        row = {
+            "team_id": team_id,
+            "item_id": item_id,
+            "role": role,
+            "content": content,
+            "timestamp": datetime.utcnow(),
+        }
+        self._pending.append(row)
+        self._wakeup.set()
+        if len(self._pending) >= self._max_batch:
+            self._full.set()
+        return ChatHistory(**row)
+
+    async def history(self, db, team_id: int, item_id: str, since: Optional[datetime] = None,
+                      before: Optional[datetime] = None, limit: Optional[int] = None) -> List[ChatHistory]:
+        """Returns a team/item's chat history in order, including rows not yet flushed.
+
+        `since`/`before` are exclusive timestamp bounds; `limit` keeps the newest rows.
+        """
+        # Bounds from clients may carry an offset; rows are naive UTC
+        since = to_naive_utc(since) if since is not None else None
+        before = to_naive_utc(before) if before is not None else None
+        query = select(ChatHistory).where(
+            ChatHistory.team_id == team_id,
+            ChatHistory.item_id == item_id
+        )
+        if since is not None:
+            query = query.where(ChatHistory.timestamp > since)
+        if before is not None:
+            query = query.where(ChatHistory.timestamp < before)
+        if limit is not None:
+            query = query.order_by(ChatHistory.timestamp.desc(), ChatHistory.id.desc()).limit(limit)
+        else:
+            query = query.order_by(ChatHistory.timestamp, ChatHistory.id)
+
+        # Connection before lock, as in flush: a caller holding the lock never waits on the pool
+        await db.connection()
+        async with self._lock:
+            records = list((await db.scalars(query)).all())
+            if limit is not None:
+                records.reverse()
+            records.extend(
+                ChatHistory(**row) for row in self._pending
+                if row["team_id"] == team_id and row["item_id"] == item_id
+                and (since is None or row["timestamp"] > since)
+                and (before is None or row["timestamp"] < before)
+            )
+        return records[-limit:] if limit is not None else records
+
+    async def discard(self, team_id: int, item_id: Optional[str] = None):
+        """Drops buffered rows for a team (or one of its items) before their rows are deleted."""
+        async with self._lock:
+            self._pending = [row for row in self._pending
+                             if not (row["team_id"] == team_id and (item_id is None or row["item_id"] == item_id))]
+
+    async def flush_pending(self):
+        """Commits every row buffered so far, e.g. before other workers are told to read them."""
+        for _ in range(-(-len(self._pending) // self._max_batch)):
+            if not await self.flush():
+                break
+
+    async def flush(self) -> bool:
+        """Commits up to one batch of buffered rows. Returns False if nothing was written."""
+        if not self._pending:
+            return False
+        try:
+            async with self._session_factory() as db:
+                await db.connection()
+                async with self._lock:
+                    if not self._pending:
+                        return False
+                    batch = self._pending[:self._max_batch]
+                    await db.execute(insert(ChatHistory), batch)
+                    await db.commit()
+                    del self._pending[:len(batch)]
+                    if len(self._pending) < self._max_batch:
+                        self._full.clear()
+                    return True
+        except Exception as e:
+            # Keep the rows buffered and retry on the next tick
+            print(f"Chat journal flush failed: {e}")
+            return False
+
+    async def _run(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._full.wait(), timeout=self._flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            await self.flush()
+            if self._pending:
+                self._wakeup.set()
+
@@ -0,0 +1,148 @@
+import os
+from typing import List, Optional, Tuple
+
+from sqlalchemy import select
+
+import llm
+import metrics
+import providers
+from database import ChatHistory, ChatSummary, summary_upsert
+
+# --- Bounded Conversation Context ---
+# Gemini only sees the most recent turns that fit the item's token budget.
+# Older turns are folded into a rolling summary that is stored in
+# chat_summaries, so it is computed once rather than on every connect.
+
+DEFAULT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "8000"))
+SUMMARY_MODEL_ID = os.getenv("SUMMARY_MODEL_ID", "gemini-2.5-flash")
+HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", "30"))
+
+SUMMARY_PROMPT = """Summarize this escape-room conversation between a player ("user") and an in-game character ("model") in under 150 words.
+Keep everything the character needs to stay consistent: names and answers the player gave, items found, hints already given and puzzle progress.
+
+{previous}
+### CONVERSATION
+{transcript}"""
+
+
+def estimate_tokens(text: str) -> int:
+    # ~4 characters per token for English prose; close enough for budgeting
+    return len(text) // 4 + 1
+
+
+def token_budget(room_conf: dict, item_id: str) -> int:
+    """Per-item `context_tokens` from ROOM_CONFIG, falling back to the room, then the default."""
+    item_conf = room_conf.get("items", {}).get(item_id, {})
+    return item_conf.get("context_tokens", room_conf.get("context_tokens", DEFAULT_TOKEN_BUDGET))
+
+
+class ContextWindow:
+    """An item conversation as the model sees it: a summary plus recent turns (one per ItemSession)."""
+
+    def __init__(self, team_id: int, item_id: str, budget: int, summary: Optional[ChatSummary], records: List[ChatHistory]):
+        self.team_id = team_id
+        self.item_id = item_id
+        self.budget = budget
+        self.summary = summary.content if summary else ""
+        self.covered_until = summary.covered_until if summary else None
+        self.records = records
+
+    @classmethod
+    async def load(cls, db, journal, team_id: int, item_id: str, budget: int) -> "ContextWindow":
+        summary = await db.scalar(select(ChatSummary).where(
+            ChatSummary.team_id == team_id,
+            ChatSummary.item_id == item_id
+        ))
+        since = summary.covered_until if summary else None
+        records = await journal.history(db, team_id, item_id, since=since)
+        return cls(team_id, item_id, budget, summary, records)
+
+    def add(self, record: ChatHistory):
+        self.records.append(record)
+
+    def tokens(self) -> int:
+        return estimate_tokens(self.summary) + sum(estimate_tokens(r.content) for r in self.records)
+
+    def over_budget(self) -> bool:
+        return self.tokens() > self.budget
+
+    async def compact(self, db) -> bool:
+        """Folds the oldest turns into the summary until the window is at half budget.
+
+        Compacting to half (rather than just under) the budget means the summary
+        call happens once every several turns, not on every turn past the limit.
+        Returns False (and leaves the window alone) if the summary call fails.
+        """
+        target = self.budget // 2
+        keep = len(self.records)
+        used = 0
+        while keep > 1:
+            cost = estimate_tokens(self.records[keep - 1].content)
+            if used + cost > target:
+                break
+            used += cost
+            keep -= 1
+        older, recent = self.records[:keep], self.records[keep:]
+        if not older:
+            return False
+
+        try:
+            summary = await summarize(self.summary, older)
+        except Exception as e:
+            print(f"GenAI Error (summary): {e}")
+            metrics.GENAI_ERRORS.inc(self.item_id, "summary")
+            return False
+
+        covered_until = older[-1].timestamp
+        await db.execute(summary_upsert(self.team_id, self.item_id, summary, covered_until))
+        await db.commit()
+
+        self.summary = summary
+        self.covered_until = covered_until
+        self.records = recent
+        return True
+
+    def first_page(self, limit: int = HISTORY_PAGE_SIZE) -> Optional[Tuple[List[dict], Optional[str]]]:
+        """The newest page as history_page would return it, from the records in memory.
+
+        None if the page reaches back past the summary, into rows only the DB has.
+        """
+        if len(self.records) > limit:
+            records = self.records[-limit:]
+            return to_frontend(records), records[0].timestamp.isoformat()
+        if self.covered_until is None:
+            return to_frontend(self.records), None
+        return None
+
+    def history(self) -> List[dict]:
+        """Gemini chat history: the summary (as a system note) followed by the recent turns."""
+        history = []
+        if self.summary:
+            history.append({"role": "user", "parts": [f"[System Note: Summary of the earlier conversation]\n{self.summary}"]})
+            history.append({"role": "model", "parts": ["Understood."]})
+        history.extend({"role": r.role, "parts": [r.content]} for r in self.records)
+        return history
+
+
+async def summarize(previous: str, records: List[ChatHistory]) -> str:
+    transcript = "\n".join(f"{r.role}: {r.content}" for r in records)
+    prompt = SUMMARY_PROMPT.format(
+        previous=f"### SUMMARY SO FAR\n{previous}\n" if previous else "",
+        transcript=transcript
+    )
+    summary = await llm.run_blocking(providers.get_provider().generate, SUMMARY_MODEL_ID, prompt)
+    return summary.strip()
+
+
+def to_frontend(records: List[ChatHistory]) -> List[dict]:
+    return [{"role": "ai" if r.role == "model" else "user", "text": r.content} for r in records]
+
+
+async def history_page(db, journal, team_id: int, item_id: str, before=None, limit: int = HISTORY_PAGE_SIZE):
+    """Newest `limit` messages older than `before`, plus a cursor for the page before them."""
+    records = await journal.history(db, team_id, item_id, before=before, limit=limit + 1)
+    cursor = None
+    if len(records) > limit:
+        records = records[1:]
+        cursor = records[0].timestamp.isoformat()
+    return to_frontend(records), cursor
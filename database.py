@@ -1,14 +1,117 @@
-from sqlalchemy import create_engine, Column, Integer, String, ForeignKey, JSON, DateTime
+import os
+from datetime import timezone
+
+from sqlalchemy import create_engine, event, inspect, text, make_url, update, Boolean, Integer, String, ForeignKey, JSON, DateTime, Index, TypeDecorator
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
 from sqlalchemy.orm import sessionmaker, relationship, DeclarativeBase, Mapped, mapped_column
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.pool import QueuePool
 from sqlalchemy.sql import func
 
-DATABASE_URL = "sqlite:///./game.db"
-
-engine = create_engine(
-    DATABASE_URL, connect_args={"check_same_thread": False}
-)
+# --- Connection Settings ---
+# DATABASE_URL is any SQLAlchemy URL; SQLite (the default) and PostgreSQL are
+# supported. The async engine uses the matching async driver unless
+# ASYNC_DATABASE_URL says otherwise:
+#   sqlite:///./game.db            -> sqlite+aiosqlite:///./game.db
+#   postgresql://user:pw@host/db   -> postgresql+asyncpg://user:pw@host/db
+DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./game.db")
+ASYNC_DRIVERS = {"sqlite": "aiosqlite", "postgresql": "asyncpg"}
+
+def async_url(url: str) -> str:
+    parsed = make_url(url)
+    backend = parsed.get_backend_name()
+    if backend not in ASYNC_DRIVERS:
+        raise ValueError(f"No async driver known for '{backend}'; set ASYNC_DATABASE_URL")
+    return parsed.set(drivername=f"{backend}+{ASYNC_DRIVERS[backend]}").render_as_string(hide_password=False)
+
+ASYNC_DATABASE_URL = os.getenv("ASYNC_DATABASE_URL") or async_url(DATABASE_URL)
+BACKEND = make_url(DATABASE_URL).get_backend_name()
+
+# Pool sizing applies per process and per engine. Each worker has a sync engine
+# (only used at startup for create_all/migrate_db) and the async one serving requests.
+POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() in ("1", "true", "yes")
+POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))  # seconds; -1 never recycles
+# SQLAlchemy's compiled-statement cache, and asyncpg's prepared statements per connection
+STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "500"))
+
+def engine_options(url: str) -> dict:
+    """create_engine keyword arguments for `url` from the settings above."""
+    parsed = make_url(url)
+    options = {
+        "pool_pre_ping": POOL_PRE_PING,
+        "pool_recycle": POOL_RECYCLE,
+        "query_cache_size": STATEMENT_CACHE_SIZE,
+    }
+    # Only queue pools take a size; e.g. sqlite:///:memory: gets a single-connection pool
+    if issubclass(parsed.get_dialect().get_pool_class(parsed), QueuePool):
+        options["pool_size"] = POOL_SIZE
+        options["max_overflow"] = MAX_OVERFLOW
+    if parsed.get_backend_name() == "sqlite":
+        options["connect_args"] = {"check_same_thread": False}
+    elif parsed.get_driver_name() == "asyncpg":
+        options["connect_args"] = {"prepared_statement_cache_size": STATEMENT_CACHE_SIZE}
+    return options
+
+engine = create_engine(DATABASE_URL, **engine_options(DATABASE_URL))
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# Async engine for the FastAPI endpoints, so DB I/O doesn't block the event loop.
+# expire_on_commit=False keeps loaded attributes usable after a commit
+# (an expired attribute would need an implicit lazy load, which async can't do).
+async_engine = create_async_engine(ASYNC_DATABASE_URL, **engine_options(ASYNC_DATABASE_URL))
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
+# --- SQLite Connection Profile ---
+# WAL lets readers proceed while the journal flushes, and synchronous=NORMAL
+# only fsyncs at checkpoints (safe in WAL mode). busy_timeout makes concurrent
+# writers wait for the lock instead of failing with "database is locked".
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "busy_timeout": 5000,       # ms
+    "cache_size": -65536,       # negative = KiB, i.e. 64 MiB page cache
+    "mmap_size": 268435456,     # 256 MiB
+    "temp_store": "MEMORY",
+}
+
+def _apply_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for pragma, value in SQLITE_PRAGMAS.items():
+        cursor.execute(f"PRAGMA {pragma}={value}")
+    cursor.close()
+
+if BACKEND == "sqlite":
+    event.listen(engine, "connect", _apply_sqlite_pragmas)
+    event.listen(async_engine.sync_engine, "connect", _apply_sqlite_pragmas)
+
+class UTCDateTime(TypeDecorator):
+    """UTC timestamps that read back as naive UTC datetimes on every backend.
+
+    The app works in naive UTC (datetime.utcnow()). PostgreSQL stores these
+    columns as timestamptz, so values are made aware on the way in and
+    converted back on the way out; SQLite stores them as they are.
+    """
+    impl = DateTime(timezone=True)
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        value = to_naive_utc(value)
+        return value.replace(tzinfo=timezone.utc) if dialect.name == "postgresql" else value
+
+    def process_result_value(self, value, dialect):
+        return to_naive_utc(value) if value is not None else None
+
+def to_naive_utc(value):
+    """`value` as a naive UTC datetime (aware values are converted, naive ones assumed UTC)."""
+    if value.tzinfo is None:
+        return value
+    return value.astimezone(timezone.utc).replace(tzinfo=None)
+
 # New SQLAlchemy 2.0 Base
 class Base(DeclarativeBase):
     pass
@@ -20,10 +123,16 @@ class Team(Base):
     name: Mapped[str] = mapped_column(String, unique=True, index=True)
     game_state: Mapped[dict] = mapped_column(JSON, default={})
     completion_time: Mapped[DateTime] = mapped_column(DateTime, nullable=True)
+    # Bumped by every write to the row. ORM flushes check it automatically and
+    # TeamStateCache.save_state compares-and-sets it, so two workers can't
+    # silently overwrite each other's game_state.
+    state_version: Mapped[int] = mapped_column(Integer, nullable=False, server_default="1")
 
     inventory: Mapped[list["InventoryItem"]] = relationship(back_populates="team")
     chat_history: Mapped[list["ChatHistory"]] = relationship(back_populates="team")
 
+    __mapper_args__ = {"version_id_col": state_version}
+
 class InventoryItem(Base):
     __tablename__ = "inventory"
 
@@ -34,6 +143,11 @@ class InventoryItem(Base):
 
     team: Mapped["Team"] = relationship(back_populates="inventory")
 
+    # One row per item per team; lets add_to_inventory upsert instead of SELECT-then-INSERT
+    __table_args__ = (
+        Index("uq_inventory_team_name", "team_id", "name", unique=True),
+    )
+
 class ChatHistory(Base):
     __tablename__ = "chat_history"
 
@@ -42,30 +156,98 @@ class ChatHistory(Base):
     item_id: Mapped[str] = mapped_column(String, index=True) # e.g., 'sparky', 'coordinator'
     role: Mapped[str] = mapped_column(String) # 'user' or 'model'
     content: Mapped[str] = mapped_column(String)
-    timestamp: Mapped[DateTime] = mapped_column(DateTime(timezone=True), server_default=func.now())
+    timestamp: Mapped[DateTime] = mapped_column(UTCDateTime, server_default=func.now())
 
     team: Mapped["Team"] = relationship(back_populates="chat_history")
 
+    # Covers the history query: team_id = ? AND item_id = ? ORDER BY timestamp
+    __table_args__ = (
+        Index("ix_chat_history_team_item_ts", "team_id", "item_id", "timestamp"),
+    )
+
+class ChatSummary(Base):
+    __tablename__ = "chat_summaries"
+
+    id: Mapped[int] = mapped_column(primary_key=True, index=True)
+    team_id: Mapped[int] = mapped_column(ForeignKey("teams.id"))
+    item_id: Mapped[str] = mapped_column(String)
+    content: Mapped[str] = mapped_column(String) # Rolling summary of the turns that left the context window
+    covered_until: Mapped[DateTime] = mapped_column(UTCDateTime) # Timestamp of the last turn folded in
+
+    __table_args__ = (
+        Index("uq_chat_summaries_team_item", "team_id", "item_id", unique=True),
+    )
+
+class TeamEvent(Base):
+    __tablename__ = "team_events"
+
+    # Change notifications between workers when TEAM_BUS=db (see bus.py)
+    id: Mapped[int] = mapped_column(primary_key=True)
+    team_id: Mapped[int] = mapped_column(Integer)
+    origin: Mapped[str] = mapped_column(String) # Worker that made the change
+    deleted: Mapped[bool] = mapped_column(Boolean, default=False)
+    discard: Mapped[str] = mapped_column(String, nullable=True) # Chat buffer to drop: an item_id or "*"
+    chat: Mapped[str] = mapped_column(String, nullable=True) # Item whose conversation got new rows
+    created_at: Mapped[DateTime] = mapped_column(UTCDateTime, server_default=func.now())
+
 def create_db_and_tables():
     # This is safe to run multiple times. It will only create tables that don't exist.
     Base.metadata.create_all(bind=engine)
-
-def get_db():
-    db = SessionLocal()
-    try:
+    migrate_db()
+
+def migrate_db():
+    """Upgrades an existing database in place. Every step is idempotent.
+
+    create_all() only creates missing tables, so columns and indexes added to
+    tables that already exist have to be applied here.
+    """
+    with engine.begin() as conn:
+        team_columns = {c["name"] for c in inspect(conn).get_columns("teams")}
+        if "completion_time" not in team_columns:
+            conn.execute(text("ALTER TABLE teams ADD COLUMN completion_time TIMESTAMP"))
+        if "state_version" not in team_columns:
+            conn.execute(text("ALTER TABLE teams ADD COLUMN state_version INTEGER NOT NULL DEFAULT 1"))
+        if "chat" not in {c["name"] for c in inspect(conn).get_columns("team_events")}:
+            conn.execute(text("ALTER TABLE team_events ADD COLUMN chat VARCHAR"))
+
+        # Older versions could insert the same item twice; keep the first copy
+        # so the unique index can be built.
+        conn.execute(text(
+            "DELETE FROM inventory WHERE id NOT IN "
+            "(SELECT MIN(id) FROM inventory GROUP BY team_id, name)"
+        ))
+
+        for table in (InventoryItem.__table__, ChatHistory.__table__):
+            for index in table.indexes:
+                index.create(conn, checkfirst=True)
+
+# INSERT ... ON CONFLICT for the configured backend (both dialects share the API)
+dialect_insert = postgresql_insert if BACKEND == "postgresql" else sqlite_insert
+
+def summary_upsert(team_id: int, item_id: str, content: str, covered_until):
+    """INSERT-or-replace for a team/item's rolling conversation summary."""
+    stmt = dialect_insert(ChatSummary).values(
+        team_id=team_id, item_id=item_id, content=content, covered_until=covered_until
+    )
+    return stmt.on_conflict_do_update(
+        index_elements=["team_id", "item_id"],
+        set_={"content": stmt.excluded.content, "covered_until": stmt.excluded.covered_until}
+    )
+
+def inventory_upsert(team_id: int, item_name: str, item_icon: str):
+    """INSERT for an inventory item that is a no-op if the team already has it."""
+    return dialect_insert(InventoryItem).values(
+        team_id=team_id, name=item_name, icon=item_icon
+    ).on_conflict_do_nothing(index_elements=["team_id", "name"])
+
+def team_version_bump(team_id: int):
+    """UPDATE marking a team's row as changed without touching game_state; returns the new state_version."""
+    return (
+        update(Team).where(Team.id == team_id)
+        .values(state_version=Team.state_version + 1)
+        .returning(Team.state_version)
+    )
+
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
         yield db
-    finally:
-        db.close()
-
-def add_to_inventory(db, team_id: int, item_name: str, item_icon: str):
-    """Adds an item to a team's inventory."""
-    # First, check if the item already exists in the team's inventory
-    existing_item = db.query(InventoryItem).filter_by(team_id=team_id, name=item_name).first()
-    if existing_item:
-        return existing_item # Or you might want to raise an error or handle it differently
-
-    new_item = InventoryItem(team_id=team_id, name=item_name, icon=item_icon)
-    db.add(new_item)
-    db.commit()
-    db.refresh(new_item)
-    return new_item
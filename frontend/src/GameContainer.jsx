@@ -4,6 +4,41 @@ import { X, Send, MapPin, Terminal, MonitorPlay, Database, Activity, Cloud, User
 const API_BASE_URL = "http://34.68.148.178:8080";
 const WS_BASE_URL = "ws://34.68.148.178:8080"; // WebSocket Base URL
 
+// --- Streaming Helpers ---
+// Replies arrive as `chunk` frames followed by a final frame carrying the clean text.
+const appendChunk = (prev, chunk) => {
+  const last = prev[prev.length - 1];
+  if (last?.queued) return [...prev.slice(0, -1), { role: 'ai', text: chunk, streaming: true }];
+  if (last?.streaming) return [...prev.slice(0, -1), { ...last, text: last.text + chunk }];
+  return [...prev, { role: 'ai', text: chunk, streaming: true }];
+};
+// A `queued` frame means the reply is waiting for a model slot; shown until it starts.
+const showQueued = (prev, data) => {
+  const text = data.reason === 'rate_limit'
+    ? `[Signal throttled. Retrying in ${data.retry_after}s...]`
+    : `[Uplink busy. Position ${data.position} in queue...]`;
+  const last = prev[prev.length - 1];
+  if (last?.queued) return [...prev.slice(0, -1), { ...last, text }];
+  return [...prev, { role: 'ai', text, streaming: true, queued: true }];
+};
+const finishStream = (prev, text) => {
+  const last = prev[prev.length - 1];
+  if (last?.streaming) return [...prev.slice(0, -1), { role: 'ai', text }];
+  return [...prev, { role: 'ai', text }];
+};
+
+// --- State Delta Helpers ---
+// With `delta=true` the item socket sends only what changed since the last frame.
+const applyStateDelta = (state, delta) => {
+  const next = { ...state, ...(delta.set || {}) };
+  (delta.unset || []).forEach(key => { delete next[key]; });
+  return next;
+};
+const applyInventoryDelta = (items, delta) => {
+  const removed = new Set(delta.inventory_removed || []);
+  return [...items.filter(item => !removed.has(item.name)), ...(delta.inventory_added || [])];
+};
+
 // --- Components ---
 
 const VictoryScreen = ({ letter, onNextRoom }) => (
@@ -136,8 +171,13 @@ function GameContainer() {
   const [coordinatorMessages, setCoordinatorMessages] = useState([{ role: 'ai', text: "Mission Control online. Signal strength: 100%. I am here to guide you." }]);
   const [coordinatorInput, setCoordinatorInput] = useState("");
 
+  // History Paging (the server only sends the newest page on connect)
+  const [historyCursor, setHistoryCursor] = useState(null);
+  const [coordinatorCursor, setCoordinatorCursor] = useState(null);
+
   // Refs for WebSockets
   const itemSocket = useRef(null);
+  const stateVersion = useRef(null); // Last state_version applied from the item socket
   const coordinatorSocket = useRef(null);
   const containerRef = useRef(null);
   const chatEndRef = useRef(null);
@@ -218,21 +258,41 @@ function GameContainer() {
   // --- WebSocket Logic: Item Interaction ---
   useEffect(() => {
     if (selectedItem && activeTeam) {
-        const ws = new WebSocket(`${WS_BASE_URL}/ws/${activeTeam.id}/${selectedItem.id}`);
+        const versionParam = stateVersion.current !== null ? `&state_version=${stateVersion.current}` : "";
+        const ws = new WebSocket(`${WS_BASE_URL}/ws/${activeTeam.id}/${selectedItem.id}?stream=true&delta=true${versionParam}`);
         
         ws.onopen = () => console.log("Item WS Connected");
         ws.onmessage = (event) => {
             const data = JSON.parse(event.data);
             if (data.history) {
-                // Prepend the history to the initial description message
-                setMessages(prev => [...prev, ...data.history]);
+                // Prepend the history to the initial description message; a reload
+                // (the conversation was reset on the server) replaces what came after it
+                setMessages(prev => [...(data.reload ? prev.slice(0, 1) : prev), ...data.history]);
+                setHistoryCursor(data.history_cursor || null);
+                if (data.snapshot) {
+                    setGameState(data.snapshot.game_state);
+                    setInventory(data.snapshot.inventory);
+                    setIsRoomCompleted(!!data.snapshot.game_state.room_completed);
+                }
+                stateVersion.current = data.state_version;
+            } else if (data.user_message !== undefined) {
+                // A teammate's message on this item; its reply follows on this socket too
+                setMessages(prev => [...prev, { role: 'user', text: data.user_message }]);
+            } else if (data.queued) {
+                setMessages(prev => showQueued(prev, data));
+            } else if (data.chunk !== undefined) {
+                setMessages(prev => appendChunk(prev, data.chunk));
             } else if (data.error) {
-                setMessages(prev => [...prev, { role: 'ai', text: `Error: ${data.error}` }]);
+                setMessages(prev => [...prev.filter(m => !m.queued), { role: 'ai', text: `Error: ${data.error}` }]);
             } else {
-                setMessages(prev => [...prev, { role: 'ai', text: data.response }]);
-                if (data.inventory) setInventory(data.inventory);
-                if (data.room_completed) setIsRoomCompleted(true);
-                if (data.game_state) setGameState(data.game_state);
+                setMessages(prev => finishStream(prev, data.response));
+                const delta = data.state_delta;
+                if (delta) {
+                    setGameState(prev => applyStateDelta(prev, delta));
+                    setInventory(prev => applyInventoryDelta(prev, delta));
+                    if (delta.set?.room_completed) setIsRoomCompleted(true);
+                }
+                stateVersion.current = data.state_version;
             }
         };
         ws.onclose = () => console.log("Item WS Closed");
@@ -245,15 +305,22 @@ function GameContainer() {
   useEffect(() => {
     if (activeTeam) {
         // Connect to coordinator immediately when team is active
-        const ws = new WebSocket(`${WS_BASE_URL}/ws/${activeTeam.id}/coordinator`);
+        const ws = new WebSocket(`${WS_BASE_URL}/ws/${activeTeam.id}/coordinator?stream=true`);
         
         ws.onopen = () => console.log("Coordinator WS Connected");
         ws.onmessage = (event) => {
             const data = JSON.parse(event.data);
             if (data.history) {
                 setCoordinatorMessages(data.history);
+                setCoordinatorCursor(data.history_cursor || null);
+            } else if (data.user_message !== undefined) {
+                setCoordinatorMessages(prev => [...prev, { role: 'user', text: data.user_message }]);
+            } else if (data.queued) {
+                setCoordinatorMessages(prev => showQueued(prev, data));
+            } else if (data.chunk !== undefined) {
+                setCoordinatorMessages(prev => appendChunk(prev, data.chunk));
             } else {
-                setCoordinatorMessages(prev => [...prev, { role: 'ai', text: data.response }]);
+                setCoordinatorMessages(prev => finishStream(prev, data.response));
             }
         };
         
@@ -263,6 +330,27 @@ function GameContainer() {
   }, [activeTeam, currentRoom]); // Re-connect if activeTeam or room changes
 
 
+  // --- History Paging ---
+  const fetchOlderHistory = async (itemId, cursor) => {
+    const res = await fetch(`${API_BASE_URL}/history/${activeTeam.id}/${itemId}?before=${encodeURIComponent(cursor)}`);
+    return res.json();
+  };
+
+  const loadOlderMessages = async () => {
+    if (!selectedItem || !historyCursor) return;
+    const data = await fetchOlderHistory(selectedItem.id, historyCursor);
+    // Keep the item description on top
+    setMessages(prev => [prev[0], ...data.history, ...prev.slice(1)]);
+    setHistoryCursor(data.history_cursor);
+  };
+
+  const loadOlderCoordinatorMessages = async () => {
+    if (!coordinatorCursor) return;
+    const data = await fetchOlderHistory('coordinator', coordinatorCursor);
+    setCoordinatorMessages(prev => [...data.history, ...prev]);
+    setCoordinatorCursor(data.history_cursor);
+  };
+
   // Debug Draw Handlers
   const getRelativeCoords = (e) => {
     if (!containerRef.current) return { x: 0, y: 0 };
@@ -394,6 +482,7 @@ function GameContainer() {
             <div className="text-xs text-emerald-600 tracking-wider">LIVE FEED</div>
           </div>
           <div className="flex-1 overflow-y-auto p-4 space-y-3 scrollbar-thin scrollbar-thumb-emerald-900/50">
+              {coordinatorCursor && <button onClick={loadOlderCoordinatorMessages} className="w-full text-[10px] text-emerald-600 hover:text-emerald-400 uppercase tracking-widest">Load earlier transmissions</button>}
               {coordinatorMessages.map((msg, idx) => (
                   <div key={idx} className={`flex ${msg.role === 'user' ? 'justify-end' : 'justify-start'}`}>
                       <div className={`max-w-[90%] rounded px-3 py-1.5 text-xs ${msg.role === 'user' ? 'bg-emerald-600/20 text-emerald-100 border border-emerald-500/30' : 'text-emerald-300'}`}>{msg.text}</div>
@@ -448,6 +537,7 @@ function GameContainer() {
               <button onClick={closeModal} className="text-slate-400 hover:text-white"><X size={24} /></button>
             </div>
             <div className="flex-1 overflow-y-auto p-4 space-y-4">
+              {historyCursor && <button onClick={loadOlderMessages} className="w-full text-xs text-slate-400 hover:text-slate-200">Load earlier messages</button>}
               {messages.map((msg, idx) => (
                 <div key={idx} className={`flex ${msg.role === 'user' ? 'justify-end' : 'justify-start'}`}>
                   <div className={`max-w-[85%] rounded-lg p-3 text-sm leading-relaxed ${msg.role === 'user' ? 'bg-blue-600/20 text-blue-100 border border-blue-500/30' : `bg-slate-700/50 text-slate-100 border ${currentTheme.color.replace('text', 'border')}/30`}`} style={{ whiteSpace: 'pre-wrap' }}>{msg.text}</div>
@@ -1,29 +1,26 @@
 import React, { useState, useEffect } from 'react';
 import { Award, Zap, ChevronRight } from 'lucide-react';
 
-const API_BASE_URL = "http://34.68.148.178:8080";
+const WS_BASE_URL = "ws://34.68.148.178:8080";
 
 const Leaderboard = ({ onRestart, currentTeam }) => {
     const [teams, setTeams] = useState([]);
     const [loading, setLoading] = useState(true);
 
     useEffect(() => {
-        const fetchTeams = async () => {
-            try {
-                const res = await fetch(`${API_BASE_URL}/teams`);
-                const data = await res.json();
-                const sortedTeams = data
-                    .filter(team => team.completion_time)
-                    .sort((a, b) => new Date(a.completion_time) - new Date(b.completion_time));
-                setTeams(sortedTeams);
-            } catch (err) {
-                console.error("Failed to fetch teams for leaderboard", err);
-            } finally {
-                setLoading(false);
-            }
+        // The server pushes the ranking on connect and whenever it changes
+        const ws = new WebSocket(`${WS_BASE_URL}/ws/leaderboard`);
+        ws.onmessage = (event) => {
+            const data = JSON.parse(event.data);
+            // Already ranked by the server; only finished teams are shown here
+            setTeams(data.leaderboard.filter(team => team.completion_time));
+            setLoading(false);
         };
-
-        fetchTeams();
+        ws.onerror = (err) => {
+            console.error("Failed to connect to the leaderboard feed", err);
+            setLoading(false);
+        };
+        return () => ws.close();
     }, []);
 
     const getRankColor = (rank) => {
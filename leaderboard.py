@@ -0,0 +1,101 @@
+import os
+import json
+import asyncio
+from typing import Dict, List, Optional, Set
+
+from sqlalchemy import select
+
+from database import Team
+
+# --- Leaderboard Broadcast ---
+# The ranking is kept in memory and pushed to /ws/leaderboard subscribers, so
+# any number of dashboards cost one computation per change instead of each
+# polling GET /teams. Changes are coalesced: at most one frame goes out every
+# LEADERBOARD_MIN_INTERVAL seconds.
+
+MIN_INTERVAL = float(os.getenv("LEADERBOARD_MIN_INTERVAL", "1.0"))
+
+
+def _entry(team) -> dict:
+    """Leaderboard row for a Team or TeamSnapshot."""
+    state = team.game_state or {}
+    return {
+        "id": team.id,
+        "name": team.name,
+        "current_room": state.get("current_room"),
+        "collected_letters": state.get("collected_letters", []),
+        "completion_time": team.completion_time.isoformat() if team.completion_time else None,
+    }
+
+
+def _rank_key(entry: dict):
+    # Finished teams first (earliest wins), then by letters collected
+    finished = entry["completion_time"] is not None
+    return (not finished, entry["completion_time"] or "", -len(entry["collected_letters"]), entry["name"])
+
+
+class Leaderboard:
+    def __init__(self, min_interval: float = MIN_INTERVAL):
+        self._min_interval = min_interval
+        self._entries: Dict[int, dict] = {}
+        self._subscribers: Set[asyncio.Queue] = set()
+        self._frame: Optional[str] = None
+        self._changed = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self, session_factory):
+        """Loads every team once and starts the broadcast task."""
+        async with session_factory() as db:
+            for team in (await db.scalars(select(Team))).all():
+                self._entries[team.id] = _entry(team)
+        self._changed = asyncio.Event()
+        self._frame = self._encode()
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def update(self, team):
+        """Records a team's latest state; only schedules a broadcast if its row changed."""
+        entry = _entry(team)
+        if self._entries.get(team.id) != entry:
+            self._entries[team.id] = entry
+            self._changed.set()
+
+    def remove(self, team_id: int):
+        if self._entries.pop(team_id, None) is not None:
+            self._changed.set()
+
+    def ranking(self) -> List[dict]:
+        return sorted(self._entries.values(), key=_rank_key)
+
+    def _encode(self) -> str:
+        return json.dumps({"leaderboard": self.ranking()})
+
+    def subscribe(self) -> asyncio.Queue:
+        """Returns a queue that always holds (at most) the newest frame, starting with the current one."""
+        queue = asyncio.Queue(maxsize=1)
+        queue.put_nowait(self._frame or self._encode())
+        self._subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        self._subscribers.discard(queue)
+
+    async def _run(self):
+        while True:
+            await self._changed.wait()
+            self._changed.clear()
+            self._frame = self._encode()
+            for queue in self._subscribers:
+                # A slow dashboard skips straight to the newest ranking
+                if queue.full():
+                    queue.get_nowait()
+                queue.put_nowait(self._frame)
+            await asyncio.sleep(self._min_interval)
@@ -0,0 +1,68 @@
+import os
+import asyncio
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+from scheduler import FairScheduler
+
+# --- Async LLM Execution ---
+# Provider chat calls are blocking (and tool calls run our sync tools in
+# between chunks), so they are pushed onto a bounded thread pool. Every call is
+# admitted by the fair-share scheduler first (see scheduler.py), which caps how
+# many are in flight across every socket on this worker.
+# Calls run in a copy of the caller's contextvars, so tools can tell which
+# connection they are serving (see main.current_team).
+
+MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "64"))
+MAX_PENDING_PER_CONNECTION = int(os.getenv("LLM_MAX_PENDING_PER_CONNECTION", "2"))
+
+_executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENCY, thread_name_prefix="llm")
+scheduler = FairScheduler(MAX_CONCURRENCY)
+
+
+async def run_blocking(func, *args):
+    """Runs a blocking model call on the LLM pool without stalling the event loop."""
+    async with scheduler.slot():
+        loop = asyncio.get_running_loop()
+        metrics.MODEL_CALLS_IN_FLIGHT.inc()
+        try:
+            context = contextvars.copy_context()
+            return await loop.run_in_executor(_executor, context.run, func, *args)
+        finally:
+            metrics.MODEL_CALLS_IN_FLIGHT.dec()
+
+
+async def stream_message(chat, content):
+    """Async generator over the text chunks of a streamed chat reply."""
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    done = object()
+
+    def produce():
+        try:
+            for text in chat.stream(content):
+                loop.call_soon_threadsafe(queue.put_nowait, text)
+        except Exception as e:
+            loop.call_soon_threadsafe(queue.put_nowait, e)
+        finally:
+            loop.call_soon_threadsafe(queue.put_nowait, done)
+
+    async with scheduler.slot():
+        metrics.MODEL_CALLS_IN_FLIGHT.inc()
+        try:
+            future = loop.run_in_executor(_executor, contextvars.copy_context().run, produce)
+            while True:
+                item = await queue.get()
+                if item is done:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+            await future
+        finally:
+            metrics.MODEL_CALLS_IN_FLIGHT.dec()
+
+
+def shutdown():
+    _executor.shutdown(wait=False, cancel_futures=True)
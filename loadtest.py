@@ -0,0 +1,269 @@
+import argparse
+import asyncio
+import json
+import random
+import time
+import urllib.parse
+import urllib.request
+from collections import defaultdict
+from typing import Dict, List
+
+import websockets
+
+# --- Load Test ---
+# Plays scripted walkthroughs for N teams at once against a running backend,
+# using the same sockets as GameContainer.jsx: a coordinator socket kept open
+# for the whole room and one item socket per selected item. Start the server
+# with the offline model stand-in so replies come back without Gemini:
+#
+#   LLM_PROVIDER=fake FAKE_LLM_LATENCY=lognormal:0.8,0.4 python main.py
+#   python loadtest.py --teams 50 --think-time 2 --output results.json
+#
+# Results (JSON) are grouped per room: turn latency (until the final
+# "response" frame), time to the first streamed chunk, connect latency (until
+# the history frame), errors, turns that got a "queued" frame and turns per second.
+
+# Each step is (item_id, message). The scripts match the room transitions and
+# the fake provider's default script (providers.DEFAULT_SCRIPT).
+WALKTHROUGHS = {
+    "databricks-room": [
+        ("coordinator", "What do we have in our inventory?"),
+        ("sparky", "Hi Sparky, any hints?"),
+        ("books", "Search the pile of books"),
+        ("terminal", "unity"),
+        ("terminal", "serverless"),
+        ("terminal", "insert the key"),
+    ],
+    "snowflake-room": [
+        ("credits_burner", "hello"),
+        ("fire", "search the ashes"),
+        ("data_marketplace", "C"),
+        ("snowman_autoscaler", "use the flat rate shield"),
+        ("cfo_yeti", "A flat rate shield: predictable, fixed cost"),
+    ],
+    "microsoft-room": [
+        ("clippy_2", "hi"),
+        ("managers_desk", "search the desk"),
+        ("control_panel", "use the gemini chip to fix it"),
+        ("control_panel", "B"),
+    ],
+}
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """Nearest-rank percentile of `values` (0 when empty)."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, round(pct / 100 * len(ordered) + 0.5) - 1))
+    return ordered[rank]
+
+
+def latency_summary(values: List[float]) -> Dict[str, float]:
+    return {
+        "count": len(values),
+        "p50_ms": round(percentile(values, 50) * 1000, 1),
+        "p95_ms": round(percentile(values, 95) * 1000, 1),
+        "p99_ms": round(percentile(values, 99) * 1000, 1),
+        "max_ms": round(max(values, default=0.0) * 1000, 1),
+    }
+
+
+class Stats:
+    def __init__(self):
+        self.turns = defaultdict(list)
+        self.first_chunk = defaultdict(list)
+        self.connects = defaultdict(list)
+        self.errors = defaultdict(lambda: defaultdict(int))
+        self.completed = defaultdict(int)
+        self.queued = defaultdict(int)
+
+    def error(self, room: str, kind: str):
+        self.errors[room][kind] += 1
+
+    def report(self, elapsed: float, config: dict) -> dict:
+        rooms = {}
+        for room in sorted(set(self.turns) | set(self.connects) | set(self.errors)):
+            rooms[room] = {
+                "turn_latency": latency_summary(self.turns[room]),
+                "first_chunk_latency": latency_summary(self.first_chunk[room]),
+                "connect_latency": latency_summary(self.connects[room]),
+                "errors": dict(self.errors[room]),
+                "completed_teams": self.completed[room],
+                "queued_turns": self.queued[room],
+                "turns_per_second": round(len(self.turns[room]) / elapsed, 2) if elapsed else 0.0,
+            }
+        all_turns = [t for values in self.turns.values() for t in values]
+        all_connects = [t for values in self.connects.values() for t in values]
+        return {
+            "config": config,
+            "elapsed_seconds": round(elapsed, 2),
+            "total": {
+                "turn_latency": latency_summary(all_turns),
+                "connect_latency": latency_summary(all_connects),
+                "errors": sum(sum(kinds.values()) for kinds in self.errors.values()),
+                "turns_per_second": round(len(all_turns) / elapsed, 2) if elapsed else 0.0,
+            },
+            "rooms": rooms,
+        }
+
+
+def post(url: str, data: dict, form: bool = False) -> dict:
+    if form:
+        body, content_type = urllib.parse.urlencode(data).encode(), "application/x-www-form-urlencoded"
+    else:
+        body, content_type = json.dumps(data).encode(), "application/json"
+    request = urllib.request.Request(url, data=body, headers={"Content-Type": content_type}, method="POST")
+    with urllib.request.urlopen(request, timeout=30) as response:
+        return json.loads(response.read())
+
+
+class Player:
+    """One team playing through the rooms the way the frontend would."""
+
+    def __init__(self, args, stats: Stats, name: str):
+        self.args = args
+        self.stats = stats
+        self.name = name
+        self.team_id = None
+        self.current_room = None
+        self.state_version = None
+        self.room_completed = False
+
+    def ws_url(self, item_id: str) -> str:
+        base = self.args.url.replace("http", "ws", 1)
+        if item_id == "coordinator":
+            return f"{base}/ws/{self.team_id}/coordinator?stream=true"
+        version = f"&state_version={self.state_version}" if self.state_version is not None else ""
+        return f"{base}/ws/{self.team_id}/{item_id}?stream=true&delta=true{version}"
+
+    async def connect(self, room: str, item_id: str):
+        started = time.perf_counter()
+        ws = await websockets.connect(self.ws_url(item_id), open_timeout=self.args.timeout, max_size=None)
+        frame = json.loads(await asyncio.wait_for(ws.recv(), self.args.timeout))
+        self.stats.connects[room].append(time.perf_counter() - started)
+        if "state_version" in frame:
+            self.state_version = frame["state_version"]
+        if frame.get("snapshot"):
+            self.room_completed = bool(frame["snapshot"]["game_state"].get("room_completed"))
+        return ws
+
+    async def turn(self, room: str, ws, message: str):
+        started = time.perf_counter()
+        await ws.send(message)
+        first_chunk = None
+        while True:
+            frame = json.loads(await asyncio.wait_for(ws.recv(), self.args.timeout))
+            if "chunk" in frame:
+                if first_chunk is None:
+                    first_chunk = time.perf_counter() - started
+                continue
+            if frame.get("queued"):
+                # The scheduler is holding this turn back (see scheduler.py)
+                self.stats.queued[room] += 1
+                continue
+            if "error" in frame:
+                # Error frames also carry a "response"; only "busy" has a fixed code
+                self.stats.error(room, "busy" if frame["error"] == "busy" else "server_error")
+                return
+            if "response" in frame:
+                break
+        self.stats.turns[room].append(time.perf_counter() - started)
+        if first_chunk is not None:
+            self.stats.first_chunk[room].append(first_chunk)
+        if "state_version" in frame:
+            self.state_version = frame["state_version"]
+        if (frame.get("state_delta") or {}).get("set", {}).get("room_completed"):
+            self.room_completed = True
+
+    async def think(self):
+        if self.args.think_time:
+            await asyncio.sleep(self.args.think_time * random.uniform(0.5, 1.5))
+
+    async def play_room(self, room: str):
+        self.room_completed = False
+        coordinator = await self.connect(room, "coordinator")
+        item_id, item_ws = None, None
+        try:
+            for step_item, message in WALKTHROUGHS[room]:
+                await self.think()
+                if step_item == "coordinator":
+                    await self.turn(room, coordinator, message)
+                    continue
+                if step_item != item_id:
+                    # Selecting another item closes the previous item socket
+                    if item_ws is not None:
+                        await item_ws.close()
+                    item_id, item_ws = step_item, await self.connect(room, step_item)
+                await self.turn(room, item_ws, message)
+        finally:
+            if item_ws is not None:
+                await item_ws.close()
+            await coordinator.close()
+        if self.room_completed:
+            self.stats.completed[room] += 1
+        else:
+            self.stats.error(room, "not_completed")
+
+    async def enter(self, room: str):
+        """Calls /next-room until the team is in `room`, skipping the rooms in between."""
+        while self.current_room != room:
+            reply = await asyncio.to_thread(post, f"{self.args.url}/next-room", {"team_id": self.team_id})
+            if reply["current_room"] == self.current_room:
+                raise RuntimeError(f"Could not reach {room} from {self.current_room}")
+            self.current_room = reply["current_room"]
+
+    async def run(self):
+        try:
+            team = await asyncio.to_thread(post, f"{self.args.url}/register", {"name": self.name}, True)
+        except Exception as e:
+            self.stats.error("register", type(e).__name__)
+            return
+        self.team_id = team["id"]
+        self.current_room = team["game_state"].get("current_room")
+        for room in self.args.rooms:
+            try:
+                await self.enter(room)
+                await self.play_room(room)
+            except Exception as e:
+                self.stats.error(room, type(e).__name__)
+                return
+
+
+async def main(args):
+    stats = Stats()
+    run_id = f"{int(time.time()) % 100000}"
+    players = [Player(args, stats, f"load-{run_id}-{i}") for i in range(args.teams)]
+
+    async def start(i: int, player: Player):
+        # Spread team starts over the ramp-up window
+        if args.ramp_up:
+            await asyncio.sleep(args.ramp_up * i / max(1, args.teams))
+        await player.run()
+
+    started = time.perf_counter()
+    await asyncio.gather(*(start(i, p) for i, p in enumerate(players)))
+    elapsed = time.perf_counter() - started
+
+    config = {k: v for k, v in vars(args).items() if k != "output"}
+    report = stats.report(elapsed, config)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    print(text)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="WebSocket load test for the escape room backend.")
+    parser.add_argument("--url", default="http://localhost:8080", help="Backend base URL")
+    parser.add_argument("--teams", type=int, default=10, help="Number of teams playing at once")
+    parser.add_argument("--rooms", nargs="+", default=list(WALKTHROUGHS), choices=list(WALKTHROUGHS),
+                        help="Rooms to play; they are played in game order and rooms left out are skipped with /next-room")
+    parser.add_argument("--think-time", type=float, default=1.0, help="Mean pause between messages (seconds)")
+    parser.add_argument("--ramp-up", type=float, default=0.0, help="Seconds over which team starts are spread")
+    parser.add_argument("--timeout", type=float, default=60.0, help="Timeout for a connect or a single turn (seconds)")
+    parser.add_argument("--output", help="Also write the JSON report to this file")
+    args = parser.parse_args()
+    args.rooms = sorted(set(args.rooms), key=list(WALKTHROUGHS).index)
+    asyncio.run(main(args))
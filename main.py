@@ -4,24 +4,110 @@ import json
 import asyncio
 import random
 from datetime import datetime
-from typing import Dict, List, Optional
-from fastapi import FastAPI, Depends, Form, HTTPException, WebSocket, WebSocketDisconnect
+from typing import Dict, List, Optional, Tuple
+import time
+import secrets
+from collections import namedtuple
+from contextvars import ContextVar
+from fastapi import FastAPI, Depends, Form, Header, HTTPException, Request, Response, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel, ConfigDict
-from sqlalchemy.orm import Session, joinedload
-import google.generativeai as genai
+from sqlalchemy import select, delete
+from sqlalchemy.orm import selectinload
+from sqlalchemy.orm.exc import StaleDataError
+from sqlalchemy.ext.asyncio import AsyncSession
 from dotenv import load_dotenv
 import uvicorn
 import importlib
 import pkgutil
+from contextlib import asynccontextmanager
 
-from database import SessionLocal, create_db_and_tables, get_db
-from database import Team, InventoryItem, ChatHistory
+# Loaded before the local modules below, which read their settings at import
+load_dotenv()
+
+import bus
+import llm
+import metrics
+import profiler
+import providers
+import scheduler
+from chat_journal import ChatJournal
+from context_window import ContextWindow, token_budget, history_page, HISTORY_PAGE_SIZE
+from tag_parser import STATE_PATTERN, ITEM_PATTERN, StreamingTagParser, parse_tag
+from state_cache import TeamStateCache, TeamSnapshot, state_delta, MAX_SAVE_ATTEMPTS
+from leaderboard import Leaderboard
+from model_registry import ModelRegistry, state_projection
+from transitions import find_transition, render_follow_ups, public_room_config
+from response_cache import ResponseCache, normalize_text, history_bucket
+from singleflight import SingleFlight
+from sessions import Subscriber, ItemSession, SessionRegistry, SESSION_DROPPED
+from database import AsyncSessionLocal, async_engine, create_db_and_tables, get_async_db
+from database import Team, InventoryItem, ChatHistory, ChatSummary, inventory_upsert, team_version_bump
 
 # Force create DB on startup
 create_db_and_tables()
 
-app = FastAPI(title="GCP Virtual Escape Room Backend")
+# Group-commits ChatHistory rows in the background (see chat_journal.py)
+chat_journal = ChatJournal(AsyncSessionLocal)
+
+# Tells other workers which teams changed (see bus.py; a no-op with one worker)
+team_bus = bus.create_bus(AsyncSessionLocal)
+
+# Each team's game_state and inventory, kept in memory (see state_cache.py).
+# Every write below goes through it or invalidates the team's entry. With a
+# bus, other workers write too, so cached entries are checked against the row.
+team_cache = TeamStateCache(shared=team_bus.name != "local")
+
+# Ranking pushed to /ws/leaderboard dashboards (see leaderboard.py)
+leaderboard = Leaderboard()
+
+# Rendered system instructions and their GenerativeModels (see model_registry.py)
+model_registry = ModelRegistry()
+
+# Replies reused for items with "cache_responses" in ROOM_CONFIG (see response_cache.py)
+response_cache = ResponseCache()
+
+# Turns in flight, shared by teammates asking an item the same thing (see singleflight.py)
+inflight = SingleFlight()
+
+# A finished turn: reply text for the client, raw model text (tags included) for
+# chat sessions, the team's state after it, its chat rows and where the reply came from
+TurnReply = namedtuple("TurnReply", ["text", "raw", "team", "records", "source"])
+
+# Each team's open conversation with each item, shared by its sockets (see sessions.py)
+item_sessions = SessionRegistry()
+
+async def on_remote_team_change(team_id: int, deleted: bool, discard: Optional[str], chat: Optional[str]):
+    """Another worker committed a change to this team: drop our copy and refresh what depends on it."""
+    if chat is not None:
+        # A turn there added to this item's conversation; our sockets on it reload it
+        item_sessions.drop(team_id, chat)
+        return
+    if discard is not None:
+        await chat_journal.discard(team_id, None if discard == "*" else discard)
+        item_sessions.drop(team_id, None if discard == "*" else discard)
+    team_cache.invalidate(team_id)
+    if deleted:
+        leaderboard.remove(team_id)
+        return
+    async with AsyncSessionLocal() as db:
+        team = await team_cache.get(db, team_id)
+    if team is not None:
+        leaderboard.update(team)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    chat_journal.start()
+    await leaderboard.start(AsyncSessionLocal)
+    await team_bus.start(on_remote_team_change)
+    yield
+    await team_bus.close()
+    await leaderboard.close()
+    await chat_journal.close()
+    llm.shutdown()
+    await async_engine.dispose()
+
+app = FastAPI(title="GCP Virtual Escape Room Backend", lifespan=lifespan)
 
 GEMINI_LETTERS = ["G", "E", "M", "I", "N", "I"]
 
@@ -80,13 +166,11 @@ load_rooms()
 ROOM_ORDER = ["databricks-room", "snowflake-room", "microsoft-room", "gemini-room"]
 
 # Configuration
-load_dotenv()
-API_KEY = os.getenv("GEMINI_API_KEY")
-if not API_KEY:
-    print("Warning: GEMINI_API_KEY not found in .env file.")
-
-genai.configure(api_key=API_KEY)
+# LLM_PROVIDER=fake runs without Gemini (see providers.py)
+provider = providers.get_provider()
 MODEL_ID = os.getenv("GEMINI_MODEL_ID", "gemini-2.5-pro")
+# Required (as X-Admin-Token) by the /admin/profile endpoints; they are disabled without it
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
 
 origins = ["http://localhost:3000", "http://localhost:5173", "http://localhost:8000", "*"]
 
@@ -95,19 +179,21 @@ app.add_middleware(
     allow_origins=origins,
     allow_credentials=True,
     allow_methods=["*"],
-    allow_headers=["*"]
+    allow_headers=["*"],
+    expose_headers=["ETag", "X-Next-Cursor", "X-Profiled-Turns"]
 )
 
 # --- Tools ---
 
-def check_inventory(team_id: int) -> List[str]:
-    """Checks the inventory for a specific team and returns a list of item names."""
-    db = SessionLocal()
-    try:
-        items = db.query(InventoryItem).filter(InventoryItem.team_id == team_id).all()
-        return [item.name for item in items]
-    finally:
-        db.close()
+# The team whose turn is being answered. Set by the socket before each model
+# call; llm.py runs the call (and so the tools) in a copy of that context.
+current_team: ContextVar[TeamSnapshot] = ContextVar("current_team")
+
+def check_inventory() -> List[str]:
+    """Checks the current team's inventory and returns a list of item names."""
+    team = current_team.get()
+    # Prefer the cached entry, which also has items added since the turn started
+    return (team_cache.peek(team.id) or team).inventory_names()
 
 # --- Pydantic Models ---
 
@@ -124,343 +210,792 @@ class TeamInfo(BaseModel):
     inventory: List[InventoryItemResponse]
     completion_time: Optional[datetime] = None
 
+class TeamSummary(BaseModel):
+    id: int
+    name: str
+    letters: int
+    current_room: Optional[str] = None
+    completion_time: Optional[datetime] = None
+
 class AddItemRequest(BaseModel):
     name: str
     icon: str
 
 # --- Helper Functions ---
 
-def process_ai_response(ai_text: str, team: Team, item_id: str, db: Session, room_id: str):
-    """Parses AI text for state updates and actions, updating the DB accordingly."""
+async def apply_ai_tag(tag: tuple, team: TeamSnapshot, db: AsyncSession, room_id: str, updates: dict):
+    """Applies one parsed command tag (see tag_parser.parse_tag) to the team."""
+    kind = tag[0]
+    if kind == "state":
+        _, key, final_value = tag
+        if key is None:
+            return
+        current_state = dict(team.game_state)
+        current_state[key] = final_value
+        team.game_state = current_state
+        updates[key] = final_value
+
+        # Generic Trigger for Room Completion
+        if key == 'room_completed' and final_value is True:
+             award_letter(team, room_id)
+
+    elif kind == "item":
+        _, item_name, item_icon = tag
+        await add_to_inventory(db, team.id, item_name, item_icon)
+
+async def process_ai_response(ai_text: str, team: TeamSnapshot, item_id: str, db: AsyncSession, room_id: str):
+    """Parses AI text for state updates and actions, updating the DB accordingly.
+
+    State updates are applied to `team` only; the caller saves them through
+    team_cache.save_state and records the cleaned text in the chat history.
+    """
     
     updates = {}
     
     # 1. Handle State Updates (Iterate over ALL matches)
-    # pattern: [STATE_UPDATE: key=value]
-    state_pattern = r"\[STATE_UPDATE:\s*(.+?)\]"
-    for match in re.finditer(state_pattern, ai_text):
-        state_str = match.group(1).strip()
-        
-        if "=" in state_str:
-            key, value = state_str.split("=", 1)
-            current_state = dict(team.game_state)
-            key, value = key.strip(), value.strip()
-            
-            if value.lower() == 'true': final_value = True
-            elif value.lower() == 'false': final_value = False
-            elif value.isdigit(): final_value = int(value)
-            else: final_value = value
-                
-            current_state[key] = final_value
-            team.game_state = current_state
-            updates[key] = final_value
-            
-            # Generic Trigger for Room Completion
-            if key == 'room_completed' and final_value is True:
-                 award_letter(team, room_id)
+    for match in re.finditer(STATE_PATTERN, ai_text):
+        await apply_ai_tag(parse_tag(match.group(0)), team, db, room_id, updates)
 
     # 2. Handle Item Additions
-    # pattern: [ADD_ITEM: name="Item Name" icon="💡"]
-    item_pattern = r'\[ADD_ITEM:\s*name="([^"]+)"\s*icon="([^"]+)"\]'
-    for match in re.finditer(item_pattern, ai_text):
-        item_name = match.group(1)
-        item_icon = match.group(2)
-        add_to_inventory(db, team.id, item_name, item_icon)
-
+    for match in re.finditer(ITEM_PATTERN, ai_text):
+        await apply_ai_tag(parse_tag(match.group(0)), team, db, room_id, updates)
 
     # Remove all command tags from the text
-    ai_text = re.sub(state_pattern, "", ai_text).strip()
-    ai_text = re.sub(item_pattern, "", ai_text).strip()
-
-    # Save Cleaned Text to Chat History
-    db.add(ChatHistory(team_id=team.id, item_id=item_id, role="model", content=ai_text))
+    ai_text = re.sub(STATE_PATTERN, "", ai_text).strip()
+    ai_text = re.sub(ITEM_PATTERN, "", ai_text).strip()
     
     return ai_text, updates
 
+async def stream_ai_response(chunks, team: TeamSnapshot, item_id: str, db: AsyncSession, room_id: str, send_json):
+    """Streaming counterpart of process_ai_response.
+
+    Forwards clean text to the client as `chunk` frames while the model is still
+    generating. Tags are held back by the parser and applied as soon as they close.
+    """
+    parser = StreamingTagParser()
+    updates = {}
+    shown = []
+
+    async def emit(text: str, tags: list):
+        for tag in tags:
+            await apply_ai_tag(tag, team, db, room_id, updates)
+        if text:
+            shown.append(text)
+            await send_json({"chunk": text})
+
+    async for chunk in chunks:
+        await emit(*parser.feed(chunk))
+    await emit(*parser.close())
+
+    ai_text = "".join(shown).strip()
+    return ai_text, updates
+
+async def record_chunks(chunks, parts: list):
+    """Passes streamed chunks through while keeping the raw text (tags included)."""
+    async for chunk in chunks:
+        parts.append(chunk)
+        yield chunk
+
+def render_system_instruction(team: TeamSnapshot, room_id: str, room_conf: dict, item_id: str) -> str:
+    """Renders an item's system prompt from the team's current state (via the room handlers)."""
+    system_instruction = ""
+
+    # Handlers
+    handle_terminal = ROOM_HANDLERS['terminal']
+    handle_books = ROOM_HANDLERS['books']
+    # Get the specific handler for this room ID
+    handle_room_item = ROOM_HANDLERS['room_specific'].get(room_id)
+
+    # Determine System Instruction (Initial State)
+    if item_id == 'coordinator':
+        inv_names = [i.name for i in team.inventory]
+        prompt_template = room_conf.get("mission_control_prompt", "You are a helpful assistant.")
+        system_instruction = prompt_template.format(
+            current_room=room_conf.get('name', room_id),
+            inventory=", ".join(inv_names) if inv_names else "Empty"
+        )
+    elif item_id == 'terminal' and handle_terminal:
+        system_instruction = handle_terminal(team, "") # Get initial prompt
+    elif item_id == 'books' and handle_books:
+        system_instruction = handle_books(team, "")
+    else:
+        # Check specific room item handlers (like sparky)
+        if handle_room_item:
+             # We pass an empty string as user_query just to get the prompt
+             prompt_or_msg, _, _ = handle_room_item(team, item_id, "")
+             # If it returns a tuple, the first element is the prompt/msg
+             # Only use it if it's not a generic "INFO:" string which handle_room_item returns by default
+             if isinstance(prompt_or_msg, str) and not prompt_or_msg.startswith("INFO:"):
+                 system_instruction = prompt_or_msg
+             else:
+                 system_instruction = room_conf.get('system_instruction', "You are a helpful assistant.")
+        else:
+             system_instruction = room_conf.get('system_instruction', "You are a helpful assistant.")
+
+    return system_instruction
+
 # --- Endpoints ---
 
+@app.get("/metrics")
+def get_metrics():
+    """Turn stage timings, open sockets and model call counts in the Prometheus text format."""
+    return Response(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
 @app.get("/api/room/{room_id}")
 def get_room_config(room_id: str):
     if room_id not in ROOM_CONFIGS:
         raise HTTPException(status_code=404, detail="Room not found")
-    return ROOM_CONFIGS[room_id]
+    return public_room_config(ROOM_CONFIGS[room_id])
+
+@app.get("/history/{team_id}/{item_id}")
+async def get_history_page(team_id: int, item_id: str, before: Optional[datetime] = None, limit: int = HISTORY_PAGE_SIZE, db: AsyncSession = Depends(get_async_db)):
+    """Older chat messages for an item, one page at a time (see `history_cursor`)."""
+    history, cursor = await history_page(db, chat_journal, team_id, item_id, before=before, limit=min(limit, 200))
+    return {"history": history, "history_cursor": cursor}
 
 @app.post("/register", response_model=TeamInfo)
-async def register_team(name: str = Form(...), db: Session = Depends(get_db)):
+async def register_team(name: str = Form(...), db: AsyncSession = Depends(get_async_db)):
     if not name.strip():
         raise HTTPException(status_code=400, detail="Team name cannot be empty.")
     
-    existing_team = db.query(Team).options(joinedload(Team.inventory)).filter(Team.name == name).first()
+    existing_team = await db.scalar(select(Team).where(Team.name == name))
     if existing_team:
         raise HTTPException(status_code=400, detail="Team name already exists.")
     
-    new_team = Team(name=name, game_state={"current_room": ROOM_ORDER[0]}, inventory=[])
+    new_team = Team(name=name, game_state={"current_room": ROOM_ORDER[0]}, completion_time=None, inventory=[])
     db.add(new_team)
-    db.commit()
-    # Explicitly refresh inventory to ensure it's loaded for Pydantic
-    db.refresh(new_team) 
-    # For good measure, ensuring it is a list
-    if new_team.inventory is None:
-         new_team.inventory = []
-         
+    await db.commit()
+    team_cache.invalidate(new_team.id) # No entry yet; bumps the /teams ETag
+    leaderboard.update(new_team)
+    team_bus.publish(new_team.id)
+    # Inventory is already loaded (empty) since expire_on_commit is off
     return new_team
 
+MAX_TEAMS_PAGE = 200
+
+def not_modified(request: Request, response: Response) -> bool:
+    """Sets the /teams ETag; True if the client's copy is still current."""
+    etag = team_cache.etag()
+    response.headers["ETag"] = etag
+    # Browsers revalidate on every poll and get a 304 while nothing has changed
+    response.headers["Cache-Control"] = "no-cache"
+    return request.headers.get("if-none-match") == etag
+
+def page_teams(query, cursor: Optional[int], limit: Optional[int]):
+    """Keyset pagination by team id; the next page's cursor goes in X-Next-Cursor."""
+    query = query.order_by(Team.id)
+    if cursor is not None:
+        query = query.where(Team.id > cursor)
+    if limit is not None:
+        query = query.limit(min(limit, MAX_TEAMS_PAGE))
+    return query
+
+def set_next_cursor(response: Response, rows, limit: Optional[int]):
+    if limit is not None and len(rows) == min(limit, MAX_TEAMS_PAGE):
+        response.headers["X-Next-Cursor"] = str(rows[-1].id)
+
 @app.get("/teams", response_model=List[TeamInfo])
-async def get_teams(db: Session = Depends(get_db)):
+async def get_teams(request: Request, response: Response, cursor: Optional[int] = None, limit: Optional[int] = None, db: AsyncSession = Depends(get_async_db)):
+    """All teams with full state and inventory; pass `limit` (and `cursor`) to page."""
+    if not_modified(request, response):
+        return Response(status_code=304, headers=dict(response.headers))
     # Eagerly load inventory to avoid Pydantic serialization issues
-    teams = db.query(Team).options(joinedload(Team.inventory)).all()
+    query = page_teams(select(Team).options(selectinload(Team.inventory)), cursor, limit)
+    teams = (await db.scalars(query)).all()
+    set_next_cursor(response, teams, limit)
     return teams
 
+@app.get("/teams/summary", response_model=List[TeamSummary])
+async def get_team_summaries(request: Request, response: Response, cursor: Optional[int] = None, limit: Optional[int] = None, db: AsyncSession = Depends(get_async_db)):
+    """Lightweight team list (no inventory or full game_state) for dashboards."""
+    if not_modified(request, response):
+        return Response(status_code=304, headers=dict(response.headers))
+    query = page_teams(select(Team.id, Team.name, Team.game_state, Team.completion_time), cursor, limit)
+    rows = (await db.execute(query)).all()
+    set_next_cursor(response, rows, limit)
+    return [
+        TeamSummary(
+            id=row.id,
+            name=row.name,
+            letters=len(row.game_state.get("collected_letters", [])),
+            current_room=row.game_state.get("current_room"),
+            completion_time=row.completion_time
+        )
+        for row in rows
+    ]
+
 @app.post("/admin/teams/{team_id}/inventory", response_model=InventoryItemResponse)
-async def add_item_to_team_inventory(team_id: int, item: AddItemRequest, db: Session = Depends(get_db)):
-    team = db.query(Team).filter(Team.id == team_id).first()
+async def add_item_to_team_inventory(team_id: int, item: AddItemRequest, db: AsyncSession = Depends(get_async_db)):
+    team = await db.get(Team, team_id)
     if not team:
         raise HTTPException(status_code=404, detail="Team not found")
     
-    add_to_inventory(db, team_id, item.name, item.icon)
+    await add_to_inventory(db, team_id, item.name, item.icon)
+    team_bus.publish(team_id)
     return InventoryItemResponse(name=item.name, icon=item.icon)
 
+def require_admin(x_admin_token: Optional[str] = Header(None)):
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Set ADMIN_TOKEN to enable this endpoint")
+    if not x_admin_token or not secrets.compare_digest(x_admin_token, ADMIN_TOKEN):
+        raise HTTPException(status_code=403, detail="Invalid admin token")
+
+@app.post("/admin/profile", dependencies=[Depends(require_admin)])
+async def profile_process(seconds: float = 10, format: str = "collapsed", interval: float = profiler.INTERVAL):
+    """Samples every thread of the server for `seconds`; `format` is "collapsed" or "speedscope"."""
+    profile = await asyncio.to_thread(profiler.sample_process, seconds, interval)
+    body, media_type = profile.export(format)
+    return Response(body, media_type=media_type)
+
+@app.post("/admin/profile/turns", dependencies=[Depends(require_admin)])
+async def profile_turns(team_id: int, item_id: str, turns: int = 1, timeout: float = 300, format: str = "collapsed"):
+    """Profiles the next `turns` turns of one team's item socket (whatever was captured by `timeout`)."""
+    capture = profiler.capture_turns(team_id, item_id, turns)
+    try:
+        await asyncio.wait_for(asyncio.shield(capture.done), timeout)
+    except asyncio.TimeoutError:
+        capture.close()
+    body, media_type = capture.profile.export(format)
+    return Response(body, media_type=media_type, headers={"X-Profiled-Turns": str(capture.turns_done)})
+
+async def retry_stale_team(db: AsyncSession, write):
+    """Runs `write()` (which loads a Team, changes it and commits), again if the team changed meanwhile.
+
+    Team rows are versioned, so the ORM flush fails with StaleDataError when a
+    turn saved the team between `write`'s read and its commit.
+    """
+    for _ in range(MAX_SAVE_ATTEMPTS):
+        try:
+            return await write()
+        except StaleDataError:
+            await db.rollback()
+            db.expunge_all()  # So the next db.get reloads the row
+    raise HTTPException(409, "Team kept changing; try again")
+
 @app.post("/reset-progress")
-async def reset_progress(request: dict, db: Session = Depends(get_db)):
-    team = db.query(Team).filter(Team.id == request['team_id']).first()
-    if not team: raise HTTPException(404, "Team not found")
+async def reset_progress(request: dict, db: AsyncSession = Depends(get_async_db)):
+    async def reset():
+        team = await db.get(Team, request['team_id'])
+        if not team: raise HTTPException(404, "Team not found")
     
-    db.query(InventoryItem).filter(InventoryItem.team_id == team.id).delete()
-    db.query(ChatHistory).filter(ChatHistory.team_id == team.id).delete() # Reset Chat History
-    team.game_state = {"current_room": ROOM_ORDER[0]}
-    team.completion_time = None
-    db.commit()
-    return {"message": "Reset", "current_room": ROOM_ORDER[0]}
+        await db.execute(delete(InventoryItem).where(InventoryItem.team_id == team.id))
+        await chat_journal.discard(team.id)
+        await db.execute(delete(ChatHistory).where(ChatHistory.team_id == team.id)) # Reset Chat History
+        await db.execute(delete(ChatSummary).where(ChatSummary.team_id == team.id))
+        team.game_state = {"current_room": ROOM_ORDER[0]}
+        team.completion_time = None
+        await db.commit()
+        team_cache.invalidate(team.id)
+        item_sessions.drop(team.id)
+        leaderboard.update(team)
+        team_bus.publish(team.id, discard="*")
+        return {"message": "Reset", "current_room": ROOM_ORDER[0]}
+
+    return await retry_stale_team(db, reset)
 
 @app.post("/next-room")
-async def next_room(request: dict, db: Session = Depends(get_db)):
-    team = db.query(Team).filter(Team.id == request['team_id']).first()
-    if not team: raise HTTPException(404, "Team not found")
+async def next_room(request: dict, db: AsyncSession = Depends(get_async_db)):
+    async def advance():
+        team = await db.get(Team, request['team_id'])
+        if not team: raise HTTPException(404, "Team not found")
     
-    current_state = dict(team.game_state)
-    current_room = current_state.get("current_room")
-    try:
-        idx = ROOM_ORDER.index(current_room)
-        if idx + 1 < len(ROOM_ORDER):
-            next_room = ROOM_ORDER[idx + 1]
-            current_state["current_room"] = next_room
-            if "room_completed" in current_state: del current_state["room_completed"]
-            if "latest_letter" in current_state: del current_state["latest_letter"]
-            team.game_state = current_state
+        current_state = dict(team.game_state)
+        current_room = current_state.get("current_room")
+        try:
+            idx = ROOM_ORDER.index(current_room)
+            if idx + 1 < len(ROOM_ORDER):
+                next_room = ROOM_ORDER[idx + 1]
+                current_state["current_room"] = next_room
+                if "room_completed" in current_state: del current_state["room_completed"]
+                if "latest_letter" in current_state: del current_state["latest_letter"]
+                team.game_state = current_state
             
-            # CRITICAL: Clear coordinator history for the new room
-            db.query(ChatHistory).filter(ChatHistory.team_id == team.id, ChatHistory.item_id == 'coordinator').delete()
+                # CRITICAL: Clear coordinator history for the new room
+                await chat_journal.discard(team.id, 'coordinator')
+                await db.execute(delete(ChatHistory).where(ChatHistory.team_id == team.id, ChatHistory.item_id == 'coordinator'))
+                await db.execute(delete(ChatSummary).where(ChatSummary.team_id == team.id, ChatSummary.item_id == 'coordinator'))
             
-            db.commit()
-            return {"current_room": next_room}
-    except:
-        pass
-    return {"current_room": current_room}
+                await db.commit()
+                team_cache.invalidate(team.id)
+                item_sessions.drop(team.id, 'coordinator')
+                leaderboard.update(team)
+                team_bus.publish(team.id, discard="coordinator")
+                return {"current_room": next_room}
+        except ValueError:
+            pass
+        return {"current_room": current_room}
+
+    return await retry_stale_team(db, advance)
 
 @app.delete("/admin/teams/{team_id}")
-async def delete_team(team_id: int, db: Session = Depends(get_db)):
-    team = db.query(Team).filter(Team.id == team_id).first()
-    if not team:
-        raise HTTPException(status_code=404, detail="Team not found")
+async def delete_team(team_id: int, db: AsyncSession = Depends(get_async_db)):
+    async def remove():
+        team = await db.get(Team, team_id)
+        if not team:
+            raise HTTPException(status_code=404, detail="Team not found")
     
-    # Cascade delete (though SQLAlchemy relationships might handle this if configured, 
-    # doing it explicitly is safer given the simple schema setup)
-    db.query(InventoryItem).filter(InventoryItem.team_id == team_id).delete()
-    db.query(ChatHistory).filter(ChatHistory.team_id == team_id).delete()
-    db.delete(team)
-    db.commit()
-    return {"message": "Team deleted successfully"}
+        # Cascade delete (though SQLAlchemy relationships might handle this if configured, 
+        # doing it explicitly is safer given the simple schema setup)
+        await db.execute(delete(InventoryItem).where(InventoryItem.team_id == team_id))
+        await chat_journal.discard(team_id)
+        await db.execute(delete(ChatHistory).where(ChatHistory.team_id == team_id))
+        await db.execute(delete(ChatSummary).where(ChatSummary.team_id == team_id))
+        await db.delete(team)
+        await db.commit()
+        team_cache.invalidate(team_id)
+        item_sessions.drop(team_id)
+        leaderboard.remove(team_id)
+        team_bus.publish(team_id, deleted=True, discard="*")
+        return {"message": "Team deleted successfully"}
+
+    return await retry_stale_team(db, remove)
 
 @app.post("/complete-challenge")
-async def complete_challenge(request: dict, db: Session = Depends(get_db)):
-    team = db.query(Team).filter(Team.id == request['team_id']).first()
-    if not team: raise HTTPException(404, "Team not found")
+async def complete_challenge(request: dict, db: AsyncSession = Depends(get_async_db)):
+    async def complete():
+        team = await db.get(Team, request['team_id'])
+        if not team: raise HTTPException(404, "Team not found")
     
-    if team.completion_time is None:
-        team.completion_time = datetime.utcnow()
+        if team.completion_time is None:
+            team.completion_time = datetime.utcnow()
 
-    current_state = dict(team.game_state)
-    current_state["game_completed"] = True
-    team.game_state = current_state
+        current_state = dict(team.game_state)
+        current_state["game_completed"] = True
+        team.game_state = current_state
     
-    db.commit()
-    return {"message": "Challenge completed"}
+        await db.commit()
+        team_cache.invalidate(team.id)
+        leaderboard.update(team)
+        team_bus.publish(team.id)
+        return {"message": "Challenge completed"}
+
+    return await retry_stale_team(db, complete)
 
 
 # --- WebSocket Endpoint (The Core "Live" Logic) ---
 
-def add_to_inventory(db: Session, team_id: int, item_name: str, icon: str):
+async def add_to_inventory(db: AsyncSession, team_id: int, item_name: str, icon: str):
     """Adds an item to a team's inventory if it doesn't already exist."""
-    existing_item = db.query(InventoryItem).filter_by(team_id=team_id, name=item_name).first()
-    if not existing_item:
-        new_item = InventoryItem(team_id=team_id, name=item_name, icon=icon)
-        db.add(new_item)
-        db.commit()
+    result = await db.execute(inventory_upsert(team_id, item_name, icon))
+    db_version = None
+    if result.rowcount:
+        # A new item changes the team, so other workers' cached copies go stale too
+        db_version = await db.scalar(team_version_bump(team_id))
+    await db.commit()
+    team_cache.add_item(team_id, item_name, icon, db_version)
+
+async def receive_into(websocket: WebSocket, inbox: asyncio.Queue, send_json):
+    """Reads user messages into a bounded per-connection inbox.
+
+    If the player keeps typing while their previous messages are still being
+    answered, extra messages are rejected instead of piling up behind the model.
+    A `None` sentinel is queued when the socket closes.
+    """
+    try:
+        while True:
+            user_text = await websocket.receive_text()
+            if inbox.qsize() >= llm.MAX_PENDING_PER_CONNECTION:
+                await send_json({
+                    "response": "Signal congested. Wait for a reply before sending more.",
+                    "error": "busy"
+                })
+                continue
+            inbox.put_nowait(user_text)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        inbox.put_nowait(None)
 
-@app.websocket("/ws/{team_id}/{item_id}")
-async def websocket_endpoint(websocket: WebSocket, team_id: int, item_id: str, db: Session = Depends(get_db)):
+@app.websocket("/ws/leaderboard")
+async def leaderboard_endpoint(websocket: WebSocket):
+    """Sends `{"leaderboard": [...]}` on connect and whenever the ranking changes."""
     await websocket.accept()
-    
-    team = db.query(Team).filter(Team.id == team_id).first()
-    if not team:
-        await websocket.close(code=4000)
-        return
+    frames = leaderboard.subscribe()
 
-    # 1. Setup Context
-    room_id = team.game_state.get("current_room", ROOM_ORDER[0])
-    room_conf = ROOM_CONFIGS.get(room_id, {})
-    
-    system_instruction = ""
-    room_completed = False
-    
-    # Handlers
-    handle_terminal = ROOM_HANDLERS['terminal']
-    handle_books = ROOM_HANDLERS['books']
-    # Get the specific handler for this room ID
-    handle_room_item = ROOM_HANDLERS['room_specific'].get(room_id)
+    async def push():
+        try:
+            while True:
+                await websocket.send_text(await frames.get())
+        except (WebSocketDisconnect, RuntimeError):
+            pass
 
-    # Determine System Instruction (Initial State)
-    if item_id == 'coordinator':
-        inv_names = [i.name for i in team.inventory]
-        prompt_template = room_conf.get("mission_control_prompt", "You are a helpful assistant.")
-        system_instruction = prompt_template.format(
-            current_room=room_conf.get('name', room_id),
-            inventory=", ".join(inv_names) if inv_names else "Empty"
-        )
-    elif item_id == 'terminal' and handle_terminal:
-        system_instruction = handle_terminal(team, "") # Get initial prompt
-    elif item_id == 'books' and handle_books:
-        system_instruction = handle_books(team, "")
+    pusher = asyncio.create_task(push())
+    metrics.WEBSOCKETS.inc("leaderboard")
+    try:
+        # Nothing is expected from dashboards; this just waits for the close
+        while True:
+            await websocket.receive_text()
+    except WebSocketDisconnect:
+        pass
+    finally:
+        pusher.cancel()
+        leaderboard.unsubscribe(frames)
+        metrics.WEBSOCKETS.dec("leaderboard")
+
+# --- Shared Item Sessions ---
+
+def session_stage(session: ItemSession, name: str):
+    """Times a block as one stage of a session's turns (see metrics.py)."""
+    return metrics.TURN_STAGE_SECONDS.time(session.room_id, session.item_id, name)
+
+def bind_model(session: ItemSession, team: TeamSnapshot):
+    """The (system_instruction, model) pair for the team's current state, from the registry."""
+    room_id, item_id = session.room_id, session.item_id
+    room_conf, item_conf = session.room_conf, session.item_conf
+    # The coordinator prompt only lists the inventory; items may declare what they read
+    prompt_keys = ["inventory"] if item_id == 'coordinator' else item_conf.get("prompt_state")
+
+    def build_model():
+        system_instruction = render_system_instruction(team, room_id, room_conf, item_id)
+        model_id = item_conf.get("model", room_conf.get("model", MODEL_ID))
+        model = provider.create_model(model_id, system_instruction, tools=[check_inventory])
+        return system_instruction, model
+
+    return model_registry.get((room_id, item_id, state_projection(team, prompt_keys)), build_model)
+
+async def open_item_session(session: ItemSession, team: TeamSnapshot):
+    """Loads the conversation and starts the model chat, once per session."""
+    session.room_conf = ROOM_CONFIGS.get(session.room_id, {})
+    session.item_conf = session.room_conf.get("items", {}).get(session.item_id, {})
+    session.system_instruction, session.model = bind_model(session, team)
+
+    # 2. Reconstruct History from DB (plus rows the journal hasn't flushed yet)
+    # Gemini gets the stored summary plus the recent turns that fit the budget;
+    # clients only get the newest page and a cursor for older ones.
+    with session_stage(session, "history"):
+        async with AsyncSessionLocal() as db:
+            session.context = await ContextWindow.load(
+                db, chat_journal, team.id, session.item_id, token_budget(session.room_conf, session.item_id)
+            )
+            if session.context.over_budget():
+                await session.context.compact(db)
+
+    # If the item is the coordinator AND it has no history,
+    # create the intro message and save it.
+    if session.item_id == 'coordinator' and not session.context.records and not session.context.summary:
+        intro_text = session.room_conf.get("mission_control_intro", "Mission Control online.")
+        session.context.add(chat_journal.append(team.id, session.item_id, "model", intro_text))
+
+    # Initialize Gemini Chat Session (Live Memory). It always streams: sockets
+    # with ?stream=true get the chunks, the others only the final frame.
+    session.chat = session.model.start_chat(history=session.context.history(), stream=True)
+
+async def session_history(session: ItemSession, db: AsyncSession):
+    """The newest history page for a joining socket, from the session's records when they cover it."""
+    page = session.context.first_page()
+    if page is None:
+        page = await history_page(db, chat_journal, session.team_id, session.item_id)
+    return page
+
+def reply_frame(subscriber: Subscriber, team: TeamSnapshot, text: str) -> dict:
+    """The final frame of a turn, in the form this socket asked for."""
+    if subscriber.delta:
+        frame = {
+            "response": text,
+            "base_version": subscriber.sent.version,
+            "state_version": team.version
+        }
+        changes = state_delta(subscriber.sent, team)
+        if changes:
+            frame["state_delta"] = changes
+        subscriber.sent = team
     else:
-        # Check specific room item handlers (like sparky)
-        if handle_room_item:
-             # We pass an empty string as user_query just to get the prompt
-             prompt_or_msg, _, _ = handle_room_item(team, item_id, "")
-             # If it returns a tuple, the first element is the prompt/msg
-             # Only use it if it's not a generic "INFO:" string which handle_room_item returns by default
-             if isinstance(prompt_or_msg, str) and not prompt_or_msg.startswith("INFO:"):
-                 system_instruction = prompt_or_msg
-             else:
-                 system_instruction = room_conf.get('system_instruction', "You are a helpful assistant.")
-        else:
-             system_instruction = room_conf.get('system_instruction', "You are a helpful assistant.")
+        frame = {
+            "response": text,
+            "inventory": [{"name": i.name, "icon": i.icon} for i in team.inventory],
+            "room_completed": team.game_state.get("room_completed", False),
+            "current_room": team.game_state.get("current_room"),
+            "game_state": team.game_state # Send full state for custom frontend logic
+        }
+    if subscriber.stream:
+        # Tells the client to replace the streamed draft with the clean text
+        frame["stream_end"] = True
+    return frame
+
+async def run_turn(session: ItemSession, sender: Subscriber, user_text: str) -> Optional[TurnReply]:
+    """Answers one message on a session and sends the result to all of its sockets.
+
+    The turn has its own DB session, so a socket waiting for input holds no
+    pooled connection. Returns None if there was no reply (the team is gone,
+    or the turn failed and every socket was sent an error frame).
+    """
+    async with session.turn_lock, AsyncSessionLocal() as db:
+        item_id, room_id = session.item_id, session.room_id
+        team = await team_cache.get(db, session.team_id)
+        if team is None:
+            return None
+        # Nothing written yet: end the read so the connection goes back to the pool while the model runs
+        await db.commit()
+        current_team.set(team)
+        version_before = team.version
+
+        async def send_chunk(payload: dict):
+            await session.broadcast(payload, streaming=True)
+
+        try:
+            # Save User Message. Teammates see the message being answered, unless they
+            # sent it too (a coalesced turn)
+            asked = normalize_text(user_text)
+            async with session.history_lock:
+                records = [chat_journal.append(team.id, item_id, "user", user_text)]
+                session.context.add(records[0])
+                await session.broadcast({"user_message": user_text}, exclude=lambda sub: sub is sender or sub.asking == asked)
 
-    # 2. Reconstruct History from DB
-    history_records = db.query(ChatHistory).filter(
-        ChatHistory.team_id == team.id,
-        ChatHistory.item_id == item_id
-    ).order_by(ChatHistory.timestamp).all()
-    
-    gemini_history = []
-    frontend_history = [] # For sending back to client
-    
-    for record in history_records:
-        # Gemini format
-        gemini_history.append({"role": record.role, "parts": [record.content]})
-        # Frontend format
-        frontend_role = "ai" if record.role == "model" else "user"
-        frontend_history.append({"role": frontend_role, "text": record.content})
+            # 4. Generate AI Response
+            # Deterministic puzzle steps declared in ROOM_CONFIG skip the model entirely,
+            # as do repeated questions to items that opt into the response cache
+            rule = find_transition(session.item_conf.get("transitions", ()), team, user_text)
+            canned = rule["response"] if rule is not None else None
+            source = "transition" if rule is not None else "model"
+            cache_key = None
+            if canned is None and session.item_conf.get("cache_responses"):
+                cache_key = (
+                    room_id, item_id,
+                    state_projection(team, session.item_conf.get("prompt_state")),
+                    normalize_text(user_text),
+                    history_bucket(len(session.context.records))
+                )
+                canned = response_cache.get(cache_key)
+                if canned is not None:
+                    source = "cache"
+
+            if canned is not None:
+                with session_stage(session, "process_response"):
+                    clean_text, updates = await process_ai_response(canned, team, item_id, db, room_id)
+                # Record the exchange in the live session as if the model had answered,
+                # tags included, so later free-form turns know the new state
+                session.chat.history = [*session.chat.history, {"role": "user", "parts": [user_text]}, {"role": "model", "parts": [canned]}]
+                raw_text = canned
+            else:
+                raw_chunks = []
+                chunks = record_chunks(llm.stream_message(session.chat, user_text), raw_chunks)
+                # Tags are applied and chunks sent while the model generates, so all of it counts as "model"
+                with session_stage(session, "model"):
+                    clean_text, updates = await stream_ai_response(chunks, team, item_id, db, room_id, send_chunk)
+                raw_text = "".join(raw_chunks)
+                if cache_key and clean_text:
+                    response_cache.put(cache_key, raw_text)
+            with session_stage(session, "commit"):
+                team = await team_cache.save_state(db, team)
+                await db.commit()
+            leaderboard.update(team)
+            if team.version != version_before:
+                team_bus.publish(team.id) # e.g. a letter from award_letter
+
+            # Follow-up text for state changes comes from ROOM_CONFIG and is rendered
+            # locally, so a transition never costs a second model round trip
+            text = clean_text
+            follow_up = render_follow_ups(session.item_conf, updates, team) if updates else None
+            if follow_up:
+                await send_chunk({"chunk": f"\n\n{follow_up}"})
+                text += f"\n\n{follow_up}"
+
+            # Rebind the session to the prompt for the team's new state (including
+            # changes made from other items); the history carries over
+            session.system_instruction, new_model = bind_model(session, team)
+            if new_model is not session.model:
+                session.model = new_model
+                session.chat = new_model.start_chat(history=session.chat.history, stream=True)
+
+            # 6. Send Response back to Frontend (every socket on the session). The reply is
+            # recorded at the same time, so a socket that joins meanwhile gets it exactly
+            # once: in its history or as this frame.
+            with session_stage(session, "send"):
+                async with session.history_lock:
+                    records.append(chat_journal.append(team.id, item_id, "model", clean_text))
+                    if follow_up:
+                        records.append(chat_journal.append(team.id, item_id, "model", follow_up))
+                    for record in records[1:]:
+                        session.context.add(record)
+                    live = [s for s in session.subscribers if s.live]
+                    frames = [reply_frame(s, team, text) for s in live]
+                    await asyncio.gather(*(s.send_json(f) for s, f in zip(live, frames)), return_exceptions=True)
+
+            # Teammates on other workers have their own session on this item; they
+            # reload it from the DB, so the rows have to be there before they hear of it
+            if team_bus.name != "local":
+                await chat_journal.flush_pending()
+                team_bus.publish(team.id, chat=item_id)
+
+            # 7. Keep the live session within budget (after the reply is out)
+            if session.context.over_budget() and await session.context.compact(db):
+                session.chat.history = session.context.history()
+
+            return TurnReply(text, raw_text, team, records, source)
+
+        except Exception as e:
+            print(f"GenAI Error: {e}")
+            metrics.GENAI_ERRORS.inc(item_id, "turn")
+            # Drop anything half-written so the cache and the DB agree again
+            await db.rollback()
+            team_cache.invalidate(session.team_id)
+            await session.broadcast({
+                "response": "Connection interference detected. Please retry.",
+                "error": str(e)
+            })
+            return None
 
-    # If the item is the coordinator AND it has no history,
-    # create the intro message, save it, and send it.
-    if item_id == 'coordinator' and not frontend_history:
-        intro_text = room_conf.get("mission_control_intro", "Mission Control online.")
-        db.add(ChatHistory(team_id=team.id, item_id=item_id, role="model", content=intro_text))
-        db.commit()
-        # Add it to the history to be sent to the client
-        frontend_history.append({"role": "ai", "text": intro_text})
-
-    # Send History to Client
-    await websocket.send_text(json.dumps({"history": frontend_history}))
-
-    # 2. Initialize Gemini Chat Session (Live Memory)
-    item_conf = room_conf.get("items", {}).get(item_id, {})
-    model_id = item_conf.get("model", room_conf.get("model", MODEL_ID))
-    
-    model = genai.GenerativeModel(
-        model_name=model_id,
-        system_instruction=system_instruction,
-        tools=[check_inventory]
-    )
-    
-    # Start the persistent chat session
-    chat = model.start_chat(enable_automatic_function_calling=True, history=gemini_history)
+@app.websocket("/ws/{team_id}/{item_id}")
+async def websocket_endpoint(websocket: WebSocket, team_id: int, item_id: str, stream: bool = False, delta: bool = False,
+                             state_version: Optional[int] = None):
+    """Chat with one item.
+
+    All of a team's sockets on an item share one conversation (see
+    sessions.py). A message sent on one of them reaches the others as a
+    `user_message` frame, and every socket gets the reply (and, with
+    `stream=true`, its chunks).
+
+    With `delta=true`, reply frames carry `state_version`/`base_version` and a
+    `state_delta` (changed game_state keys and inventory additions/removals)
+    instead of the full state. The client passes the last `state_version` it
+    applied; if that is stale it gets a full `snapshot` with the history frame.
+
+    If the session is dropped while the socket is open (a reset, the next
+    room), the socket moves to a fresh one and gets another history frame,
+    marked `reload: true`, that replaces the conversation shown.
+
+    Closes with code 4000 if the team doesn't exist and 4004 if `item_id` is
+    neither "coordinator" nor an item of the team's current room.
+    """
+    await websocket.accept()
+
+    # Serialize sends: this socket's inbox reader and the session's turns share it
+    send_lock = asyncio.Lock()
+    async def send_json(payload: dict):
+        async with send_lock:
+            await websocket.send_text(json.dumps(payload))
+
+    subscriber = Subscriber(send_json, stream, delta)
+
+    async def join_session() -> Optional[Tuple[ItemSession, TeamSnapshot]]:
+        """Joins the team's session on this item; None if the socket was closed instead."""
+        # Room handlers read team.game_state / team.inventory from the cached snapshot
+        # Every DB use below takes a short-lived session; an idle socket holds no pooled connection
+        load_started = time.perf_counter()
+        async with AsyncSessionLocal() as db:
+            team = await team_cache.get(db, team_id)
+        if not team:
+            await websocket.close(code=4000)
+            return None
+
+        # 1. Setup Context
+        room_id = team.game_state.get("current_room", ROOM_ORDER[0])
+        room_items = ROOM_CONFIGS.get(room_id, {}).get("items", {})
+        if item_id != 'coordinator' and item_id not in room_items:
+            # Not an item of the team's room (this also keeps metric labels to known items)
+            await websocket.close(code=4004)
+            return None
+        item_conf = room_items.get(item_id, {})
+        metrics.TURN_STAGE_SECONDS.observe(time.perf_counter() - load_started, room_id, item_id, "db_load")
+
+        # Model calls from this socket are scheduled as this team's, at the item's priority
+        scheduler.current_request.set(scheduler.ModelRequest(team_id, scheduler.item_priority(item_id, item_conf)))
+
+        # The first socket loads the session from the DB
+        session = await item_sessions.join(team_id, item_id, room_id, subscriber, lambda s: open_item_session(s, team))
+        return session, team
+
+    async def send_history(session: ItemSession, team: TeamSnapshot, known_version: Optional[int], reload: bool = False):
+        # Send History to Client. Turns record and announce chat rows under the same
+        # lock, so from the moment the socket goes live it gets every frame after its
+        # history, and none twice. A turn waiting on the model doesn't hold it.
+        async with session.history_lock:
+            async with AsyncSessionLocal() as db:
+                with session_stage(session, "history"):
+                    frontend_history, history_cursor = await session_history(session, db)
+                team = await team_cache.get(db, team_id) or team
+            history_frame = {"history": frontend_history, "history_cursor": history_cursor}
+            if reload:
+                history_frame["reload"] = True
+            if delta:
+                history_frame["state_version"] = team.version
+                if known_version != team.version:
+                    history_frame["snapshot"] = team.to_dict()
+            subscriber.sent = team
+            await send_json(history_frame)
+            subscriber.live = True
+
+        # From here on, a model call that has to wait tells the session's sockets instead of stalling
+        async def notify_queued(info: dict):
+            await session.broadcast({"queued": True, **info})
+        scheduler.current_request.set(scheduler.current_request.get()._replace(on_queued=notify_queued))
+
+    joined = await join_session()
+    if joined is None:
+        return
+    session, team = joined
+
+    reader = None
+    capture = None
+    metrics.WEBSOCKETS.inc(item_id)
 
     try:
+        await send_history(session, team, state_version)
+        reader = asyncio.create_task(receive_into(websocket, subscriber.inbox, send_json))
+
         while True:
             # 3. Listen for User Input
-            user_text = await websocket.receive_text()
-            
-            # Save User Message
-            db.add(ChatHistory(team_id=team.id, item_id=item_id, role="user", content=user_text))
-            db.commit()
-            
-            # Refresh Team State (in case it changed elsewhere)
-            db.refresh(team)
-            
+            user_text = await subscriber.inbox.get()
+            if user_text is None:
+                break
+            if session.closed:
+                # Its chat rows were deleted: continue on a fresh session, loaded from the DB
+                item_sessions.leave(session, subscriber)
+                subscriber.live = False
+                joined = await join_session()
+                if joined is None:
+                    session = None
+                    break
+                session, team = joined
+                await send_history(session, team, subscriber.sent.version, reload=True)
+            if user_text is SESSION_DROPPED:
+                continue
+
+            # An admin may have asked for a profile of this socket's next turns
+            capture = profiler.capture_for(team_id, item_id)
+            if capture:
+                capture.begin(asyncio.current_task())
+
+            # Latest Team State (in case it changed elsewhere), served from memory
+            with session_stage(session, "db_load"):
+                async with AsyncSessionLocal() as db:
+                    team = await team_cache.get(db, team_id)
+            if team is None:
+                break
+
             # Optional: Dynamic Prompt Injection
             pass
 
-            # 4. Generate AI Response
-            # We inject the team_id into the prompt so the tool knows which inventory to check
-            prompt_with_context = f"{user_text}\\n[System Note: team_id={team_id}]"
-            
+            # Teammates sending this item the same thing at the same moment share one turn.
+            # Keyed by the session object (team, item, room and which instance), so a socket
+            # still on a dropped session never joins a turn of the one that replaced it.
+            key = (session, normalize_text(user_text), team.version)
+            subscriber.asking = key[1]
             try:
-                response = chat.send_message(prompt_with_context)
-                ai_text = response.text
-                
-                # 5. Process Side Effects (DB updates)
-                clean_text, updates = process_ai_response(ai_text, team, item_id, db, room_id)
-                db.commit()
-                db.refresh(team)
-                
-                # Dynamic Prompt Injection for Terminal Logic
-                follow_up_text = ""
-                sys_prompt = ""
-
-                if 'terminal_stage' in updates:
-                    new_stage = updates['terminal_stage']
-                    if new_stage == 'QUESTION':
-                        sys_prompt = "[System Note: Access Granted. State updated to QUESTION. Ask the security question: 'To optimize costs and enable true scalability, what architecture must be employed?']"
-                    elif new_stage == 'KEY_SLOT':
-                        sys_prompt = "[System Note: Answer Correct. State updated to KEY_SLOT. Ask the user to insert the physical key.]"
-                    elif new_stage == 'UNLOCKED':
-                        sys_prompt = "[System Note: Key Accepted. State updated to UNLOCKED. Tell the user they are free to leave.]"
-                
-                elif 'panel_state' in updates:
-                    new_state = updates['panel_state']
-                    if new_state == 'FIXED':
-                         sys_prompt = "[System Note: STATE UPDATE. The Panel is now FIXED. You are now in the 'FIXED' state. If the user selects 'Iceberg', 'Open', or 'Option B', you MUST output: [STATE_UPDATE: room_completed=true]]"
-
-                if sys_prompt:
-                    sys_response = chat.send_message(sys_prompt)
-                    # Process the follow-up response (save to DB, check for recursive updates)
-                    sys_clean, _ = process_ai_response(sys_response.text, team, item_id, db, room_id)
-                    follow_up_text = f"\\n\\n{sys_clean}"
-
-                # Explicitly fetch inventory to ensure freshness
-                current_inventory = db.query(InventoryItem).filter(InventoryItem.team_id == team.id).all()
-
-                # 6. Send Response back to Frontend
-                final_response = clean_text + follow_up_text
-                response_data = {
-                    "response": final_response,
-                    "inventory": [{"name": i.name, "icon": i.icon} for i in current_inventory],
-                    "room_completed": team.game_state.get("room_completed", False),
-                    "current_room": team.game_state.get("current_room"),
-                    "game_state": team.game_state # Send full state for custom frontend logic
-                }
-                await websocket.send_text(json.dumps(response_data))
-                
-            except Exception as e:
-                print(f"GenAI Error: {e}")
-                await websocket.send_text(json.dumps({
-                    "response": "Connection interference detected. Please retry.",
-                    "error": str(e)
-                }))
+                reply, shared = await inflight.do(key, lambda: run_turn(session, subscriber, user_text))
+            finally:
+                subscriber.asking = None
+            if reply is not None:
+                metrics.TURNS.inc(session.room_id, item_id, "coalesced" if shared else reply.source)
+
+            if capture:
+                capture.end()
 
     except WebSocketDisconnect:
-        print(f"Client #{team_id} disconnected from {item_id}")
+        pass
+    finally:
+        if capture:
+            capture.end()
+        if reader:
+            reader.cancel()
+        if session is not None:
+            item_sessions.leave(session, subscriber)
+        metrics.WEBSOCKETS.dec(item_id)
+    print(f"Client #{team_id} disconnected from {item_id}")
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8080)
+    # WORKERS > 1 needs TEAM_BUS=db or redis so the workers see each other's changes
+    workers = int(os.getenv("WORKERS", "1"))
+    if workers > 1 and team_bus.name == "local":
+        print("Warning: WORKERS > 1 with TEAM_BUS=local; cached team state will go stale across workers.")
+    uvicorn.run("main:app" if workers > 1 else app, host="0.0.0.0", port=8080, workers=workers)
@@ -0,0 +1,154 @@
+import time
+from bisect import bisect_left
+from typing import Dict, List, Tuple
+
+# --- Metrics ---
+# A few counters, gauges and histograms served by /metrics in the Prometheus
+# text format. Updating one is a dict lookup plus an add (a bisect for
+# histograms), cheap enough for every turn. All updates happen on the event
+# loop, so there are no locks.
+
+# Seconds; turn stages range from sub-millisecond cache hits to slow model calls
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+REGISTRY: List["_Metric"] = []
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names: Tuple[str, ...], values: Tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple, object] = {}
+        REGISTRY.append(self)
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, *labels, amount: float = 1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self) -> List[str]:
+        return [f"{self.name}{_labels(self.labelnames, k)} {_number(v)}" for k, v in self._values.items()]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, *labels, amount: float = 1):
+        self._values[labels] = self._values.get(labels, 0) - amount
+
+    def set(self, value: float, *labels):
+        self._values[labels] = value
+
+
+class _Timer:
+    __slots__ = ("_histogram", "_labels", "_started")
+
+    def __init__(self, histogram: "Histogram", labels: Tuple):
+        self._histogram = histogram
+        self._labels = labels
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self._histogram.observe(time.perf_counter() - self._started, *self._labels)
+        return False
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: Tuple[str, ...] = (), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, *labels):
+        entry = self._values.get(labels)
+        if entry is None:
+            # Per-bucket counts (made cumulative when rendered), sum, count
+            entry = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        entry[0][bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+        entry[2] += 1
+
+    def time(self, *labels) -> _Timer:
+        """Context manager that observes the duration of its block."""
+        return _Timer(self, labels)
+
+    def render(self) -> List[str]:
+        lines = []
+        for labels, (counts, total, count) in self._values.items():
+            cumulative = 0
+            for bound, bucket_count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += bucket_count
+                le = 'le="+Inf"' if bound == "+Inf" else f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, labels)} {_number(total)}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, labels)} {count}")
+        return lines
+
+
+def render() -> str:
+    """All registered metrics in the Prometheus text exposition format."""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.header())
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# --- Server Metrics ---
+
+TURN_STAGE_SECONDS = Histogram(
+    "escape_room_turn_stage_seconds",
+    "Time spent per stage of a WebSocket connect or turn "
+    "(db_load, history, model, process_response, commit, send).",
+    ("room", "item", "stage")
+)
+TURNS = Counter(
+    "escape_room_turns_total",
+    "Turns answered, by where the reply came from (transition, cache, model, coalesced).",
+    ("room", "item", "source")
+)
+WEBSOCKETS = Gauge("escape_room_websockets", "Open WebSockets per item.", ("item",))
+ITEM_SESSIONS = Gauge("escape_room_item_sessions", "Open shared team/item sessions (see sessions.py).")
+ITEM_SESSIONS.set(0)
+MODEL_CALLS_IN_FLIGHT = Gauge("escape_room_model_calls_in_flight", "Model calls running on the LLM pool.")
+MODEL_CALLS_IN_FLIGHT.set(0)
+MODEL_CALLS_QUEUED = Gauge("escape_room_model_calls_queued", "Model calls waiting for the scheduler, by priority.", ("priority",))
+MODEL_QUEUE_WAIT_SECONDS = Histogram(
+    "escape_room_model_queue_wait_seconds",
+    "Time model calls that had to wait spent queued in the scheduler, by priority.",
+    ("priority",)
+)
+CACHE_LOOKUPS = Counter(
+    "escape_room_cache_lookups_total",
+    "Lookups in the response cache and the model registry, by result (hit or miss). "
+    "Cached replies per item are counted in escape_room_turns_total{source=\"cache\"}.",
+    ("cache", "result")
+)
+GENAI_ERRORS = Counter("escape_room_genai_errors_total", "Failed model calls (kind: turn or summary).", ("item", "kind"))
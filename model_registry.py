@@ -0,0 +1,59 @@
+import os
+from collections import OrderedDict
+from typing import Callable, Hashable, Iterable, Optional, Tuple
+
+import metrics
+
+# --- Model / Prompt Registry ---
+# Rendering an item's system instruction and constructing its GenerativeModel
+# happens on every WebSocket connect. Both depend only on the room, the item
+# and a slice of the team's state, so they are cached under that key and
+# shared between connections (and teams) until evicted.
+
+MAX_ENTRIES = int(os.getenv("MODEL_REGISTRY_SIZE", "512"))
+
+
+def state_projection(team, keys: Optional[Iterable[str]] = None) -> Tuple:
+    """Hashable view of the team state an item's prompt is rendered from.
+
+    `keys` is the item's `prompt_state` from ROOM_CONFIG: the game_state keys
+    the prompt reads, plus "inventory" if it lists the inventory. Without it
+    the whole game_state, inventory and team id are used, which is always
+    correct but only shared by the same team in the same state.
+    """
+    inventory = tuple(i.name for i in team.inventory)
+    if keys is None:
+        return (team.id, repr(team.game_state), inventory)
+    return tuple(
+        ("inventory", inventory) if key == "inventory" else (key, repr(team.game_state.get(key)))
+        for key in keys
+    )
+
+
+class ModelRegistry:
+    """LRU cache of (system_instruction, GenerativeModel) pairs."""
+
+    def __init__(self, max_entries: int = MAX_ENTRIES):
+        self._max_entries = max_entries
+        self._entries: "OrderedDict[Hashable, tuple]" = OrderedDict()
+
+    def get(self, key: Hashable, build: Callable[[], tuple]) -> tuple:
+        """Returns the cached pair for `key`, calling `build()` to create it on a miss."""
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+            metrics.CACHE_LOOKUPS.inc("model_registry", "hit")
+            return entry
+
+        metrics.CACHE_LOOKUPS.inc("model_registry", "miss")
+        entry = build()
+        self._entries[key] = entry
+        if len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+        return entry
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
@@ -0,0 +1,210 @@
+import os
+import sys
+import json
+import asyncio
+import threading
+import time
+from collections import Counter
+from typing import Dict, Optional, Tuple
+
+# --- Sampling Profiler ---
+# Admin endpoints (see main.py) use this to profile a live server without a
+# debugger. A background thread wakes every INTERVAL seconds and records the
+# Python stack of every thread (sys._current_frames), so the event loop, the
+# WebSocket handlers running on it and the LLM pool threads are all covered.
+# Idle threads show up too (e.g. pool workers waiting for work), which is
+# expected in a wall-clock profile.
+#
+# A TurnCapture follows a single socket instead: while one of its turns is in
+# progress it samples that handler's task only, whether it is running (its
+# frames on the loop thread) or suspended (the chain of awaits it is parked
+# on), so time spent waiting for the model or the DB is attributed too.
+#
+# Profiles export as collapsed stacks (flamegraph.pl, speedscope) or speedscope JSON.
+
+INTERVAL = float(os.getenv("PROFILER_INTERVAL", "0.005"))
+MAX_SECONDS = float(os.getenv("PROFILER_MAX_SECONDS", "120"))
+
+Frame = Tuple[str, str, int]  # function, file, first line
+
+
+def _frame_key(frame) -> Frame:
+    code = frame.f_code
+    return code.co_name, os.path.basename(code.co_filename), code.co_firstlineno
+
+
+def _thread_stack(frame) -> Tuple[Frame, ...]:
+    stack = []
+    while frame is not None:
+        stack.append(_frame_key(frame))
+        frame = frame.f_back
+    return tuple(reversed(stack))
+
+
+def _await_stack(coro) -> Tuple[Frame, ...]:
+    """Frames of a suspended coroutine and everything it is awaiting, outermost first."""
+    stack = []
+    while coro is not None:
+        frame = getattr(coro, "cr_frame", None) or getattr(coro, "ag_frame", None) or getattr(coro, "gi_frame", None)
+        if frame is None:
+            break
+        stack.append(_frame_key(frame))
+        coro = getattr(coro, "cr_await", None) or getattr(coro, "ag_await", None) or getattr(coro, "gi_yieldfrom", None)
+    return tuple(stack)
+
+
+class Profile:
+    """Sample counts per stack."""
+
+    def __init__(self, name: str, interval: float):
+        self.name = name
+        self.interval = interval
+        self.samples: Counter = Counter()
+        self.started = time.monotonic()
+        self.duration = 0.0
+
+    def add(self, stack: Tuple[Frame, ...]):
+        if stack:
+            self.samples[stack] += 1
+
+    def finish(self):
+        self.duration = time.monotonic() - self.started
+
+    def to_collapsed(self) -> str:
+        """One `frame;frame;... count` line per stack (Brendan Gregg's collapsed format)."""
+        lines = []
+        for stack, count in self.samples.most_common():
+            # Pseudo-frames (thread names, "[suspended]") have no file
+            names = (f"{func} ({file}:{line})" if file else func for func, file, line in stack)
+            names = (name.replace(";", ":") for name in names)
+            lines.append(f"{';'.join(names)} {count}")
+        return "\n".join(lines) + "\n"
+
+    def to_speedscope(self) -> dict:
+        frames, index = [], {}
+        samples, weights = [], []
+        for stack, count in self.samples.most_common():
+            ids = []
+            for frame in stack:
+                if frame not in index:
+                    index[frame] = len(frames)
+                    func, file, line = frame
+                    frames.append({"name": func, "file": file, "line": line})
+                ids.append(index[frame])
+            samples.append(ids)
+            weights.append(count * self.interval)
+        return {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "name": self.name,
+            "exporter": "escape-room profiler",
+            "shared": {"frames": frames},
+            "profiles": [{
+                "type": "sampled",
+                "name": self.name,
+                "unit": "seconds",
+                "startValue": 0,
+                "endValue": sum(weights),
+                "samples": samples,
+                "weights": weights,
+            }],
+        }
+
+    def export(self, fmt: str) -> Tuple[str, str]:
+        """(body, media type) for `fmt` "collapsed" or "speedscope"."""
+        if fmt == "speedscope":
+            return json.dumps(self.to_speedscope()), "application/json"
+        return self.to_collapsed(), "text/plain; charset=utf-8"
+
+
+def sample_process(seconds: float, interval: float = INTERVAL) -> Profile:
+    """Samples every thread for `seconds` (blocking; run it off the event loop)."""
+    profile = Profile(f"process ({seconds:g}s)", interval)
+    me = threading.get_ident()
+    deadline = time.monotonic() + min(seconds, MAX_SECONDS)
+    while time.monotonic() < deadline:
+        names = {t.ident: t.name for t in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            thread = (f"thread {names.get(ident, ident)}", "", 0)
+            profile.add((thread, *_thread_stack(frame)))
+        time.sleep(interval)
+    profile.finish()
+    return profile
+
+
+class TurnCapture:
+    """Profiles the next `turns` turns of one team/item socket."""
+
+    def __init__(self, team_id: int, item_id: str, turns: int, interval: float = INTERVAL):
+        self.key = (team_id, item_id)
+        self.turns_left = turns
+        self.turns_done = 0
+        self.interval = interval
+        self.profile = Profile(f"team {team_id} / {item_id}, next {turns} turns", interval)
+        self.done = asyncio.get_running_loop().create_future()
+        self._task: Optional[asyncio.Task] = None
+        self._loop_thread = threading.get_ident()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self._thread.start()
+
+    def begin(self, task: asyncio.Task):
+        self._task = task
+
+    def end(self):
+        """Called when the socket finishes a turn (or goes away mid-turn)."""
+        if self._task is None:
+            return
+        self._task = None
+        self.turns_done += 1
+        self.turns_left -= 1
+        if self.turns_left <= 0:
+            self.close()
+
+    def close(self):
+        self._stop.set()
+        self.profile.finish()
+        if _captures.get(self.key) is self:
+            del _captures[self.key]
+        if not self.done.done():
+            self.done.set_result(self.profile)
+
+    def _sample(self, task: asyncio.Task):
+        coro = task.get_coro()
+        root = getattr(coro, "cr_frame", None)
+        if root is None:
+            return
+        # Running if the task's own frame is on the loop thread's stack right now
+        frame = sys._current_frames().get(self._loop_thread)
+        frames = []
+        while frame is not None:
+            frames.append(frame)
+            if frame is root:
+                self.profile.add(tuple(_frame_key(f) for f in reversed(frames)))
+                return
+            frame = frame.f_back
+        self.profile.add((*_await_stack(coro), ("[suspended]", "", 0)))
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            task = self._task
+            if task is not None:
+                self._sample(task)
+
+
+_captures: Dict[Tuple[int, str], TurnCapture] = {}
+
+
+def capture_turns(team_id: int, item_id: str, turns: int) -> TurnCapture:
+    """Starts profiling the next `turns` turns of a socket; await `.done` for the Profile."""
+    previous = _captures.get((team_id, item_id))
+    if previous is not None:
+        previous.close()
+    capture = _captures[(team_id, item_id)] = TurnCapture(team_id, item_id, turns)
+    return capture
+
+
+def capture_for(team_id: int, item_id: str) -> Optional[TurnCapture]:
+    """The pending capture for this socket, if an admin asked for one (a dict lookup otherwise)."""
+    return _captures.get((team_id, item_id)) if _captures else None
@@ -0,0 +1,226 @@
+import os
+import re
+import json
+import time
+import random
+from typing import Callable, Dict, Iterator, List, Optional
+
+# --- LLM Providers ---
+# Everything the server needs from a model goes through this small interface:
+#   provider.create_model(model_id, system_instruction, tools) -> model
+#   model.start_chat(history, stream) -> chat
+#   chat.stream(content) -> Iterator[str]   (tool calls resolved internally)
+#   chat.history                       (readable / assignable, Gemini-style dicts)
+#   provider.generate(model_id, prompt) -> str   (one-shot, e.g. summaries)
+# All calls are blocking; llm.py runs them on its thread pool.
+#
+# LLM_PROVIDER selects the implementation: "gemini" (default) or "fake", an
+# offline stand-in for load tests and benchmarks (see FakeProvider).
+
+
+# --- Gemini ---
+
+class GeminiChat:
+    def __init__(self, session, tools: List[Callable]):
+        self._session = session
+        self._tools = {tool.__name__: tool for tool in tools}
+
+    @property
+    def history(self):
+        return self._session.history
+
+    @history.setter
+    def history(self, history):
+        self._session.history = history
+
+    def stream(self, content) -> Iterator[str]:
+        """Yields text parts of a streamed reply, running tool calls in between.
+
+        The SDK refuses to stream with automatic function calling enabled, so tool
+        calls are resolved here and their results sent back as a follow-up turn.
+        """
+        from google.generativeai import protos
+
+        while True:
+            response = self._session.send_message(content, stream=True)
+            calls = []
+            for chunk in response:
+                parts = chunk.candidates[0].content.parts if chunk.candidates else []
+                for part in parts:
+                    if "function_call" in part:
+                        calls.append(part.function_call)
+                    elif part.text:
+                        yield part.text
+            if not calls:
+                return
+
+            response_parts = []
+            for fc in calls:
+                result = self._tools[fc.name](**dict(fc.args))
+                response_parts.append(protos.Part(
+                    function_response=protos.FunctionResponse(name=fc.name, response={"result": result})
+                ))
+            content = protos.Content(role="user", parts=response_parts)
+
+
+class GeminiModel:
+    def __init__(self, model, tools: List[Callable]):
+        self._model = model
+        self._tools = tools
+
+    def start_chat(self, history=(), stream: bool = False) -> GeminiChat:
+        # Streaming resolves tool calls itself (see GeminiChat.stream)
+        session = self._model.start_chat(enable_automatic_function_calling=not stream, history=list(history))
+        return GeminiChat(session, self._tools)
+
+
+class GeminiProvider:
+    name = "gemini"
+
+    def __init__(self):
+        import google.generativeai as genai
+        self._genai = genai
+        api_key = os.getenv("GEMINI_API_KEY")
+        if not api_key:
+            print("Warning: GEMINI_API_KEY not found in .env file.")
+        genai.configure(api_key=api_key)
+
+    def create_model(self, model_id: str, system_instruction: str = None, tools: List[Callable] = ()) -> GeminiModel:
+        model = self._genai.GenerativeModel(
+            model_name=model_id,
+            system_instruction=system_instruction,
+            tools=list(tools) or None
+        )
+        return GeminiModel(model, list(tools))
+
+    def generate(self, model_id: str, prompt: str) -> str:
+        return self._genai.GenerativeModel(model_name=model_id).generate_content(prompt).text
+
+
+# --- Fake (offline) ---
+# Replies come from a script of rules, checked in order:
+#   {"prompt": regex on the system instruction (optional),
+#    "match": regex on the message,
+#    "tool": name of a tool to call first (optional; the match's named groups are its arguments),
+#    "reply": template; {message}, {tool_result} and the match's named groups are available}
+# FAKE_LLM_SCRIPT points to a JSON file with such a list; the default script
+# below plays the free-form steps of the rooms (the deterministic ones are
+# ROOM_CONFIG transitions). FAKE_LLM_LATENCY sets how long each reply takes:
+# "fixed:S", "uniform:LOW,HIGH" or "lognormal:MEDIAN,SIGMA" (seconds).
+
+DEFAULT_SCRIPT = [
+    {"prompt": r"books_has_dropped_key=False", "match": r"search|dig|look|take|open",
+     "reply": 'Pages flutter everywhere. A keycard slides out of "Hadoop: A Tragedy in XML". '
+              '[STATE_UPDATE: books_has_dropped_key=true] [ADD_ITEM: name="BigQuery Keycard" icon="💳"]'},
+    {"prompt": r"has_chip=true", "match": r"search|dig|look|inspect|open",
+     "reply": 'Under the overage invoices lies the Gemini Code Assist chip. '
+              '[STATE_UPDATE: desk_has_chip=false] [ADD_ITEM: name="Gemini Code Assist" icon="💾"]'},
+    {"prompt": r"fire_has_card=true", "match": r"search|look|take|poke|grab",
+     "reply": 'You pull a Platinum Corporate Credit Card out of the ashes. '
+              '[STATE_UPDATE: fire_has_card=false] [ADD_ITEM: name="Corporate Credit Card" icon="💳"]'},
+    {"prompt": r"Has Card: True", "match": r"\bc\b|shield|bigquery",
+     "reply": 'SELECTION CONFIRMED. DISPENSING SHIELD. [ADD_ITEM: name="Flat Rate Shield" icon="🛡️"]'},
+    {"prompt": r"Current Inventory:.*Flat Rate Shield", "match": r"shield|flat rate|cap",
+     "reply": "NOOO! PREDICTABILITY! MY ONLY WEAKNESS! [STATE_UPDATE: snowman_stopped=true]"},
+    {"prompt": r"Current Game State:\*\* SNOWMAN_STOPPED", "match": r"flat rate|predictab|fixed cost|shield",
+     "reply": "A flat rate... I can finally forecast my bonus! [STATE_UPDATE: room_completed=true]"},
+    {"match": r"inventory|what do (?:we|i) have", "tool": "check_inventory",
+     "reply": "Inventory scan: {tool_result}"},
+    {"match": r".", "reply": "Signal received: {message}"},
+]
+
+
+def parse_latency(spec: str) -> Callable[[], float]:
+    """Turns a FAKE_LLM_LATENCY spec into a sampler returning seconds."""
+    kind, _, args = spec.partition(":")
+    values = [float(v) for v in args.split(",")] if args else [0.0]
+    if kind == "uniform":
+        return lambda: random.uniform(values[0], values[1])
+    if kind == "lognormal":
+        median, sigma = values
+        return lambda: random.lognormvariate(0, sigma) * median
+    return lambda: values[0]
+
+
+class FakeChat:
+    def __init__(self, model: "FakeModel", history):
+        self._model = model
+        self.history = list(history)
+
+    def _reply(self, content) -> str:
+        text = content if isinstance(content, str) else str(content)
+        reply = self._model.reply(text)
+        self.history = [*self.history, {"role": "user", "parts": [text]}, {"role": "model", "parts": [reply]}]
+        return reply
+
+    def stream(self, content) -> Iterator[str]:
+        # Roughly half the latency before the first chunk, the rest spread over the others
+        total = self._model.provider.latency()
+        reply = self._reply(content)
+        size = self._model.provider.chunk_chars
+        chunks = [reply[i:i + size] for i in range(0, len(reply), size)] or [""]
+        time.sleep(total / 2)
+        for i, chunk in enumerate(chunks):
+            if i:
+                time.sleep(total / 2 / (len(chunks) - 1))
+            yield chunk
+
+
+class FakeModel:
+    def __init__(self, provider: "FakeProvider", system_instruction: str, tools: List[Callable]):
+        self.provider = provider
+        self.system_instruction = system_instruction or ""
+        self.tools = {tool.__name__: tool for tool in tools}
+
+    def start_chat(self, history=(), stream: bool = False) -> FakeChat:
+        return FakeChat(self, history)
+
+    def reply(self, message: str) -> str:
+        for rule in self.provider.script:
+            if "prompt" in rule and not re.search(rule["prompt"], self.system_instruction, re.IGNORECASE | re.DOTALL):
+                continue
+            match = re.search(rule["match"], message, re.IGNORECASE)
+            if not match:
+                continue
+            groups = {k: int(v) if v.isdigit() else v for k, v in match.groupdict().items() if v is not None}
+            tool_result = ""
+            if rule.get("tool") in self.tools:
+                tool_result = self.tools[rule["tool"]](**groups)
+            return rule["reply"].format(message=message, tool_result=tool_result, **groups)
+        return ""
+
+
+class FakeProvider:
+    name = "fake"
+
+    def __init__(self, script: Optional[List[Dict]] = None, latency: Optional[str] = None, chunk_chars: Optional[int] = None):
+        script_path = os.getenv("FAKE_LLM_SCRIPT")
+        if script is None and script_path:
+            with open(script_path) as f:
+                script = json.load(f)
+        self.script = script if script is not None else DEFAULT_SCRIPT
+        self.latency = parse_latency(latency or os.getenv("FAKE_LLM_LATENCY", "fixed:0"))
+        self.chunk_chars = chunk_chars or int(os.getenv("FAKE_LLM_CHUNK_CHARS", "16"))
+
+    def create_model(self, model_id: str, system_instruction: str = None, tools: List[Callable] = ()) -> FakeModel:
+        return FakeModel(self, system_instruction, list(tools))
+
+    def generate(self, model_id: str, prompt: str) -> str:
+        time.sleep(self.latency())
+        return f"Summary of {prompt.count(chr(10))} lines of conversation."
+
+
+PROVIDERS = {"gemini": GeminiProvider, "fake": FakeProvider}
+
+_provider = None
+
+
+def get_provider():
+    """The process-wide provider chosen by LLM_PROVIDER (created on first use)."""
+    global _provider
+    if _provider is None:
+        name = os.getenv("LLM_PROVIDER", "gemini").lower()
+        if name not in PROVIDERS:
+            raise ValueError(f"Unknown LLM_PROVIDER '{name}' (expected one of: {', '.join(PROVIDERS)})")
+        _provider = PROVIDERS[name]()
+    return _provider
@@ -0,0 +1,56 @@
+import os
+import re
+import time
+from collections import OrderedDict
+from typing import Hashable, Optional
+
+import metrics
+
+# --- LLM Response Cache ---
+# Items that opt in with "cache_responses": True in ROOM_CONFIG reuse an
+# earlier model reply when a team in the same state asks the same thing at a
+# similar point in the conversation ("hi", "help", ...). The raw reply is
+# cached, tags included, so side effects still apply on a hit.
+
+MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_SIZE", "1024"))
+TTL = float(os.getenv("RESPONSE_CACHE_TTL", "600"))
+
+
+def normalize_text(text: str) -> str:
+    """Lowercases and strips punctuation/extra whitespace so trivial variations share an entry."""
+    return " ".join(re.sub(r"[^\w\s]", " ", text.lower()).split())
+
+
+def history_bucket(turns: int) -> int:
+    """Coarse conversation depth: 0, 1, 2-3, 4-7, ... turns."""
+    return turns.bit_length()
+
+
+class ResponseCache:
+    """LRU of raw model replies that expire TTL seconds after they were stored."""
+
+    def __init__(self, max_entries: int = MAX_ENTRIES, ttl: float = TTL):
+        self._max_entries = max_entries
+        self._ttl = ttl
+        self._entries: "OrderedDict[Hashable, tuple]" = OrderedDict()
+
+    def get(self, key: Hashable) -> Optional[str]:
+        entry = self._entries.get(key)
+        if entry is not None:
+            expires, text = entry
+            if expires > time.monotonic():
+                self._entries.move_to_end(key)
+                metrics.CACHE_LOOKUPS.inc("response", "hit")
+                return text
+            del self._entries[key]
+        metrics.CACHE_LOOKUPS.inc("response", "miss")
+        return None
+
+    def put(self, key: Hashable, text: str):
+        self._entries[key] = (time.monotonic() + self._ttl, text)
+        self._entries.move_to_end(key)
+        if len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._entries)
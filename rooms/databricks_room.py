@@ -5,7 +5,6 @@ Your goal is to guide the user through a security protocol to unlock the door.
 
 **Current Context:**
 {current_state}
-team_id={team_id}
 
 **Rules & State Transitions:**
 
@@ -37,7 +36,7 @@ team_id={team_id}
 3.  **State: KEY_SLOT**
     -   You are waiting for a physical key card.
     -   **Action:** If the user says "insert key", "use key", "scan card" or similar:
-        -   **YOU MUST CALL THE TOOL:** `check_inventory(team_id={team_id})`.
+        -   **YOU MUST CALL THE TOOL:** `check_inventory()`.
         -   **If the tool output contains 'BigQuery Keycard':**
             -   Output: "KEY ACCEPTED. Releasing Vendor Lock-in mechanism... Door Unlocked."
             -   Command: [STATE_UPDATE: terminal_stage=UNLOCKED]
@@ -347,10 +346,50 @@ The user has just read a welcome message establishing the setting: they are lock
         "items": {
             "terminal": {
                 "model": "gemini-2.5-pro",
-                "description": "An old, rigid, command-line interface terminal. It looks bureaucratic."
+                "description": "An old, rigid, command-line interface terminal. It looks bureaucratic.",
+                "prompt_state": ["terminal_stage"],
+                "priority": "high",
+                # Deterministic steps of RUSTY_TERMINAL_PROMPT, answered without the model
+                "transitions": [
+                    {
+                        "when": {"terminal_stage": [None, "LOGIN"]},
+                        "match": r"\bunity\b",
+                        "response": "IDENTITY VERIFIED. Welcome, Unity Catalog Admin.\n\nProceeding to Cost Override Protocol...\n"
+                                    "[STATE_UPDATE: terminal_stage=QUESTION]"
+                    },
+                    {
+                        "when": {"terminal_stage": "QUESTION"},
+                        "match": r"\bserverless\b",
+                        "response": "CORRECT. True Serverless architecture acknowledged. Cost optimization verified.\n"
+                                    "[STATE_UPDATE: terminal_stage=KEY_SLOT]"
+                    },
+                    {
+                        "when": {"terminal_stage": "KEY_SLOT"},
+                        "match": r"\b(insert|use|scan|swipe)\b.*\b(key|card|keycard)\b",
+                        "requires_item": "BigQuery Keycard",
+                        "response": "KEY ACCEPTED. Releasing Vendor Lock-in mechanism... Door Unlocked.\n"
+                                    "[STATE_UPDATE: terminal_stage=UNLOCKED]\n[STATE_UPDATE: room_completed=true]"
+                    },
+                    {
+                        "when": {"terminal_stage": "KEY_SLOT"},
+                        "match": r"\b(insert|use|scan|swipe)\b.*\b(key|card|keycard)\b",
+                        "lacks_item": "BigQuery Keycard",
+                        "response": "ERROR: Key slot empty. You do not possess the required keycard."
+                    }
+                ],
+                # Shown after whichever reply (canned or from the model) moves the stage
+                "follow_ups": {
+                    "terminal_stage": {
+                        "QUESTION": "PROCESSING... TO OPTIMIZE COSTS AND ENABLE TRUE SCALABILITY, WHAT ARCHITECTURE MUST BE EMPLOYED?",
+                        "KEY_SLOT": "AWAITING PHYSICAL KEY INSERTION. ACTIVATE KEY SLOT TO PROCEED.",
+                        "UNLOCKED": "System Status: GREEN. You are free to leave."
+                    }
+                }
             },
             "books": {
-                "description": "A teetering stack of heavy, dust-covered manuals titled 'Oracle 8i Tuning' and 'The Joy of Silos.' It smells like 1999 and proprietary lock-in."
+                "description": "A teetering stack of heavy, dust-covered manuals titled 'Oracle 8i Tuning' and 'The Joy of Silos.' It smells like 1999 and proprietary lock-in.",
+                "prompt_state": ["books_has_dropped_key"],
+                "cache_responses": True
             },
             "poster": {
                 "description": "A peeling, pixelated poster glued to the damp wall. A raised fist clutches a data block above the command: 'OBEY UNITY.' It feels judgmental."
@@ -362,11 +401,14 @@ The user has just read a welcome message establishing the setting: they are lock
                 "description": "A chaotic nest of tangled sheets and unoptimized pillows. It looks incredibly high-maintenance and requires a 'Spark Engineer' just to make the bed."
             },
             "door": {
-                "description": "A massive, blast-proof steel slab labeled 'OUTPUT STREAM.' It has no handle, only a warning label that reads: 'Egress Fees Apply.'"
+                "description": "A massive, blast-proof steel slab labeled 'OUTPUT STREAM.' It has no handle, only a warning label that reads: 'Egress Fees Apply.'",
+                "prompt_state": ["terminal_stage"]
             },
             "sparky": {
                 "model": "gemini-2.5-pro",
-                "description": "...prisoner mumbling..."
+                "description": "...prisoner mumbling...",
+                "prompt_state": [],
+                "cache_responses": True
             }
         },
         "theme": {
@@ -391,11 +433,8 @@ def handle_terminal(team, user_query: str) -> str:
     game_state = dict(team.game_state)
     current_stage = game_state.get('terminal_stage', 'LOGIN')
     
-    # Inject current state AND team_id into the prompt
-    return RUSTY_TERMINAL_PROMPT.format(
-        current_state=f"terminal_stage={current_stage}",
-        team_id=team.id
-    )
+    # Inject current state into the prompt (check_inventory knows the team from the connection)
+    return RUSTY_TERMINAL_PROMPT.format(current_state=f"terminal_stage={current_stage}")
 
 def handle_books(team, user_query: str) -> str:
     game_state = dict(team.game_state)
@@ -129,16 +129,50 @@ ROOM_CONFIG = {
         "mission_control_prompt": MISSION_CONTROL_PROMPT,
         "items": {
             "clippy_2": {
-                "description": "A holographic paperclip with manic eyes. He looks eager to sell you a license upgrade."
+                "description": "A holographic paperclip with manic eyes. He looks eager to sell you a license upgrade.",
+                "prompt_state": [],
+                "cache_responses": True
             },
             "fabric_loom": {
-                "description": "A massive industrial machine trying to weave data. It is currently jamming and sparking."
+                "description": "A massive industrial machine trying to weave data. It is currently jamming and sparking.",
+                "prompt_state": ["room_completed"]
             },
             "managers_desk": {
-                "description": "A messy desk buried under 'Overage Invoices' and 'Rebranding Memos.' Something glows underneath."
+                "description": "A messy desk buried under 'Overage Invoices' and 'Rebranding Memos.' Something glows underneath.",
+                "prompt_state": ["desk_has_chip"]
             },
             "control_panel": {
-                "description": "A complex terminal flashing red 'CAPACITY EXCEEDED' lights. It demands a credit card or better code."
+                "description": "A complex terminal flashing red 'CAPACITY EXCEEDED' lights. It demands a credit card or better code.",
+                "prompt_state": ["room_completed", "panel_state", "inventory"],
+                "priority": "high",
+                # Deterministic steps of PANEL_PROMPT, answered without the model
+                "transitions": [
+                    {
+                        "when": {"panel_state": [None, "BROKEN"], "room_completed": [None, False]},
+                        "match": r"\b(fix|repair|optimi[sz]e|insert|use|gemini|code assist|chip)\b",
+                        "requires_item": "Gemini Code Assist",
+                        "response": "EXTERNAL INTELLIGENCE DETECTED. 'Gemini Code Assist' is rewriting the pipeline... Cross-database joins optimized. Capacity Check: BYPASSED.\n\n"
+                                    "SYSTEM ONLINE. Awaiting Protocol Selection:\n[A] OneLake (Proprietary / Locked)\n[B] Iceberg (Open / Portable)\n\n"
+                                    "Please enter selection:\n[STATE_UPDATE: panel_state=FIXED]"
+                    },
+                    {
+                        "when": {"panel_state": [None, "BROKEN"], "room_completed": [None, False]},
+                        "match": r"\b(fix|repair|optimi[sz]e|insert|use|gemini|code assist|chip)\b",
+                        "lacks_item": "Gemini Code Assist",
+                        "response": "ACCESS DENIED. Optimization requires advanced intelligence. Current 'Copilot' is busy generating poetry. Please insert valid AI tool."
+                    },
+                    {
+                        "when": {"panel_state": "FIXED", "room_completed": [None, False]},
+                        "match": r"\b(iceberg|option b)\b|^\W*\[?b\]?\W*$",
+                        "response": "PROTOCOL CONFIRMED: ICEBERG TABLES. Enabling Cross-Cloud Analytics... Silos dissolved. The Factory is now Open.\n"
+                                    "[STATE_UPDATE: room_completed=true]"
+                    },
+                    {
+                        "when": {"panel_state": "FIXED", "room_completed": [None, False]},
+                        "match": r"\b(onelake|proprietary|fabric|option a)\b|^\W*\[?a\]?\W*$",
+                        "response": "WARNING: VENDOR LOCK-IN INITIATED. Data will be converted to proprietary Delta-Parquet dialects. Interoperability will be lost. DO YOU CONFIRM? (Hint: The correct answer is **Iceberg**)."
+                    }
+                ]
             }
         },
         "theme": {
@@ -161,19 +161,26 @@ ROOM_CONFIG = {
         "mission_control_prompt": MISSION_CONTROL_PROMPT,
         "items": {
             "cfo_yeti": {
-                "description": "A massive Yeti in a torn suit, shivering violently. He isn't cold; he's having a panic attack about 'Variance' and 'Egress Fees'. He blocks the exit."
+                "description": "A massive Yeti in a torn suit, shivering violently. He isn't cold; he's having a panic attack about 'Variance' and 'Egress Fees'. He blocks the exit.",
+                "prompt_state": ["snowman_stopped", "inventory"]
             },
             "snowman_autoscaler": {
-                "description": "A cheerful snowman made of frozen server nodes. He smiles broadly while tossing credits into the air. He is the source of the spending problem."
+                "description": "A cheerful snowman made of frozen server nodes. He smiles broadly while tossing credits into the air. He is the source of the spending problem.",
+                "prompt_state": ["snowman_stopped", "inventory"]
             },
             "fire": {
-                "description": "A roaring bonfire. Upon closer inspection, it is fueling itself with bundles of cash labeled 'Q4 Budget'. Something shiny glitters inside."
+                "description": "A roaring bonfire. Upon closer inspection, it is fueling itself with bundles of cash labeled 'Q4 Budget'. Something shiny glitters inside.",
+                "prompt_state": ["fire_has_card"]
             },
             "data_marketplace": {
-                "description": "A sleek machine labeled 'Partner Ecosystem.' It sells basic functionality for an extra fee. It has a slot for a Corporate Card."
+                "description": "A sleek machine labeled 'Partner Ecosystem.' It sells basic functionality for an extra fee. It has a slot for a Corporate Card.",
+                "prompt_state": ["inventory"],
+                "priority": "high"
             },
             "credits_burner": {
-                "description": "A giant LED counter on the wall. The numbers are spinning so fast they are a blur. It emits a low, terrifying hum."
+                "description": "A giant LED counter on the wall. The numbers are spinning so fast they are a blur. It emits a low, terrifying hum.",
+                "prompt_state": ["snowman_stopped"],
+                "cache_responses": True
             }
         },
         "theme": {
@@ -0,0 +1,205 @@
+import os
+import time
+import asyncio
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import Awaitable, Callable, Dict, List, NamedTuple, Optional
+
+import metrics
+
+# --- Fair-Share Model Scheduler ---
+# Every model call (replies and summaries, see llm.py) has to be admitted here
+# first. Admission is decided by three rules:
+#   - at most `capacity` calls run at once on this worker (LLM_MAX_CONCURRENCY)
+#   - each team has a token bucket: LLM_TEAM_BURST calls at once, refilled at
+#     LLM_TEAM_RATE calls per second, so a team spamming one socket runs out
+#     of tokens instead of filling every slot
+#   - when calls have to wait, free slots go out in priority order ("high"
+#     puzzle items before "normal" items before the "low" coordinator) and,
+#     within a priority, by start-time fair queueing across teams: each
+#     waiting call is tagged max(virtual time, team's last tag), so ten queued
+#     calls from one team interleave with other teams' instead of going first
+# A call that can't start right away calls its request's `on_queued` (the
+# socket sends a "queued" frame) before it waits.
+
+TEAM_RATE = float(os.getenv("LLM_TEAM_RATE", "1.0"))  # calls per second; 0 disables the buckets
+TEAM_BURST = float(os.getenv("LLM_TEAM_BURST", "8"))
+
+PRIORITIES = {"high": 0, "normal": 1, "low": 2}
+
+# Idle teams are forgotten after this many admissions
+PRUNE_EVERY = 1000
+
+
+class ModelRequest(NamedTuple):
+    """Who a model call is made for. `on_queued(info)` is awaited if the call has to wait."""
+    team_id: Optional[int]
+    priority: str = "normal"
+    on_queued: Optional[Callable[[dict], Awaitable[None]]] = None
+
+
+# Set by the socket handling a team/item (see main.websocket_endpoint); calls
+# made without one are scheduled as an anonymous, unthrottled team.
+current_request: ContextVar[Optional[ModelRequest]] = ContextVar("current_request", default=None)
+
+
+def item_priority(item_id: str, item_conf: dict) -> str:
+    """Priority of an item's model calls: its ROOM_CONFIG "priority", "low" for the coordinator.
+
+    Items a room can't be finished without (the terminal, the control panel,
+    the data marketplace) are marked "high", so their calls go ahead of other
+    items' when the worker is at capacity.
+    """
+    if item_id == "coordinator":
+        return "low"
+    return item_conf.get("priority", "normal")
+
+
+class _Flow:
+    """One team's token bucket and fair-queueing tag."""
+    __slots__ = ("tokens", "refilled", "finish", "waiting")
+
+    def __init__(self, tokens: float, now: float):
+        self.tokens = tokens
+        self.refilled = now
+        self.finish = 0.0
+        self.waiting = 0
+
+
+class _Waiter:
+    __slots__ = ("flow", "throttled", "key", "future", "queued_at")
+
+    def __init__(self, flow: _Flow, throttled: bool, key: tuple, future: asyncio.Future):
+        self.flow = flow
+        self.throttled = throttled
+        self.key = key  # (priority rank, tag, arrival): lowest goes first
+        self.future = future
+        self.queued_at = time.perf_counter()
+
+
+class FairScheduler:
+    """Admission control for model calls; see the module comment."""
+
+    def __init__(self, capacity: int, rate: float = TEAM_RATE, burst: float = TEAM_BURST):
+        self.capacity = capacity
+        self.rate = rate
+        self.burst = max(burst, 1.0)
+        self.active = 0
+        self._flows: Dict[Optional[int], _Flow] = {}
+        self._waiters: List[_Waiter] = []
+        self._vtime = 0.0
+        self._arrivals = 0
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+    @asynccontextmanager
+    async def slot(self, request: Optional[ModelRequest] = None):
+        """Holds one admitted call for the duration of the block."""
+        await self.acquire(request)
+        try:
+            yield
+        finally:
+            self.release()
+
+    async def acquire(self, request: Optional[ModelRequest] = None):
+        """Waits until a call for `request` (default: current_request) may start."""
+        request = request or current_request.get() or ModelRequest(None)
+        now = time.monotonic()
+        self._arrivals += 1
+        if self._arrivals % PRUNE_EVERY == 0:
+            self._prune(now)
+
+        flow = self._flows.get(request.team_id)
+        if flow is None:
+            flow = self._flows[request.team_id] = _Flow(self.burst, now)
+        tag = max(self._vtime, flow.finish)
+        flow.finish = tag + 1
+        flow.waiting += 1
+
+        throttled = self.rate > 0 and request.team_id is not None
+        waiter = _Waiter(
+            flow, throttled,
+            (PRIORITIES.get(request.priority, PRIORITIES["normal"]), tag, self._arrivals),
+            asyncio.get_running_loop().create_future()
+        )
+        self._waiters.append(waiter)
+        self._dispatch()
+        if waiter.future.done():
+            return
+
+        metrics.MODEL_CALLS_QUEUED.inc(request.priority)
+        try:
+            if request.on_queued is not None:
+                await request.on_queued(self._queue_info(waiter))
+            await waiter.future
+        except BaseException:
+            # Disconnected or cancelled while waiting: give the slot (or the place) back
+            if waiter.future.done() and not waiter.future.cancelled():
+                self.release()
+            else:
+                waiter.future.cancel()
+                self._waiters.remove(waiter)
+                flow.waiting -= 1
+                self._dispatch()
+            raise
+        finally:
+            metrics.MODEL_CALLS_QUEUED.dec(request.priority)
+            metrics.MODEL_QUEUE_WAIT_SECONDS.observe(time.perf_counter() - waiter.queued_at, request.priority)
+
+    def release(self):
+        self.active -= 1
+        self._dispatch()
+
+    def _refill(self, flow: _Flow, now: float):
+        if flow.tokens < self.burst:
+            flow.tokens = min(self.burst, flow.tokens + (now - flow.refilled) * self.rate)
+        flow.refilled = now
+
+    def _ready(self, waiter: _Waiter, now: float) -> bool:
+        if not waiter.throttled:
+            return True
+        self._refill(waiter.flow, now)
+        return waiter.flow.tokens >= 1
+
+    def _dispatch(self):
+        """Admits waiting calls, best first, while slots are free."""
+        now = time.monotonic()
+        while self.active < self.capacity and self._waiters:
+            best = None
+            for waiter in self._waiters:
+                if (best is None or waiter.key < best.key) and self._ready(waiter, now):
+                    best = waiter
+            if best is None:
+                break
+            self._waiters.remove(best)
+            if best.throttled:
+                best.flow.tokens -= 1
+            best.flow.waiting -= 1
+            self.active += 1
+            self._vtime = max(self._vtime, best.key[1])
+            best.future.set_result(None)
+        self._schedule_refill(now)
+
+    def _schedule_refill(self, now: float):
+        """With free slots but only token-starved calls waiting, retries when the next token is due."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self.active >= self.capacity or not self._waiters:
+            return
+        delay = min((1 - w.flow.tokens) / self.rate for w in self._waiters if w.throttled)
+        self._timer = asyncio.get_running_loop().call_later(max(delay, 0.001), self._dispatch)
+
+    def _queue_info(self, waiter: _Waiter) -> dict:
+        """What the client is told about a waiting call."""
+        if waiter.throttled and waiter.flow.tokens < 1:
+            # This team's calls queued ahead of this one need tokens first
+            return {"reason": "rate_limit", "retry_after": round((waiter.flow.waiting - waiter.flow.tokens) / self.rate, 2)}
+        ahead = sum(1 for w in self._waiters if w.key < waiter.key)
+        return {"reason": "capacity", "position": ahead + 1}
+
+    def _prune(self, now: float):
+        for team_id, flow in list(self._flows.items()):
+            if flow.waiting == 0:
+                self._refill(flow, now)
+                if flow.tokens >= self.burst:
+                    del self._flows[team_id]
@@ -0,0 +1,134 @@
+import asyncio
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+import metrics
+from singleflight import SingleFlight
+
+# --- Shared Item Sessions ---
+# Every socket a team opens on an item (one per teammate's browser tab)
+# joins the same ItemSession, which holds:
+#   - one model chat session
+#   - one ContextWindow, loaded from the DB once
+#   - one copy of the history in memory
+# Turns from any of the sockets run on it one at a time. What a turn
+# produces goes to every socket: the sender's message, streamed chunks and
+# the reply. Teammates therefore see the same conversation. Sessions are
+# keyed by team, item and room, and close when their last socket leaves.
+# A session whose chat rows were deleted (reset, next room) is dropped; the
+# sockets still on it are woken through their inbox and move to a fresh one.
+
+SessionKey = Tuple[int, str, str]  # team_id, item_id, room_id
+
+# Queued on a socket's inbox when its session is dropped
+SESSION_DROPPED = object()
+
+
+class Subscriber:
+    """One socket in a session and the frames it asked for at connect."""
+
+    def __init__(self, send_json: Callable[[dict], Awaitable[None]], stream: bool, delta: bool):
+        self.send_json = send_json
+        self.stream = stream
+        self.delta = delta
+        # TeamSnapshot this client was last sent; delta frames are taken against it
+        self.sent = None
+        # Set once the socket has its history frame; broadcasts skip it until then
+        self.live = False
+        # Normalized text of the message this socket is waiting on a reply to, if any
+        self.asking: Optional[str] = None
+        # Messages from the client, then None when it disconnects; SESSION_DROPPED in between
+        self.inbox: asyncio.Queue = asyncio.Queue()
+
+
+class ItemSession:
+    """One team's conversation with one item; see the module comment."""
+
+    def __init__(self, key: SessionKey):
+        self.key = key
+        self.team_id, self.item_id, self.room_id = key
+        self.subscribers: List[Subscriber] = []
+        # One turn at a time: they share the chat session and the context window
+        self.turn_lock = asyncio.Lock()
+        # Held while a turn records and announces chat rows, and while a joining
+        # socket takes its history page and goes live; never across a model call
+        self.history_lock = asyncio.Lock()
+        self.closed = False
+        # Filled in by whoever opens the session (see main.open_item_session)
+        self.room_conf: dict = {}
+        self.item_conf: dict = {}
+        self.context = None
+        self.system_instruction: Optional[str] = None
+        self.model = None
+        self.chat = None
+
+    async def broadcast(self, payload: dict, streaming: bool = False,
+                        exclude: Optional[Callable[[Subscriber], bool]] = None):
+        """Sends `payload` to every live socket (only those in stream mode if `streaming`, minus `exclude`)."""
+        targets = [
+            s for s in self.subscribers
+            if s.live and (s.stream or not streaming) and not (exclude and exclude(s))
+        ]
+        # A socket that is going away fails its send; its own loop takes it out of the session
+        await asyncio.gather(*(s.send_json(payload) for s in targets), return_exceptions=True)
+
+
+class SessionRegistry:
+    """The open ItemSessions on this worker."""
+
+    def __init__(self):
+        self._sessions: Dict[SessionKey, ItemSession] = {}
+        self._opening = SingleFlight()
+
+    async def join(self, team_id: int, item_id: str, room_id: str, subscriber: Subscriber,
+                   open: Callable[[ItemSession], Awaitable[None]]) -> ItemSession:
+        """Adds `subscriber` to the team's session on this item, opening it with `open` if there is none.
+
+        Sockets that join while the session is being opened wait for it,
+        so its history is loaded once.
+        """
+        key = (team_id, item_id, room_id)
+        while True:
+            session = self._sessions.get(key)
+            if session is None:
+                session, _ = await self._opening.do(key, lambda: self._open(key, open))
+            # Closed while this socket waited for it to open: open a fresh one
+            if not session.closed:
+                session.subscribers.append(subscriber)
+                return session
+
+    async def _open(self, key: SessionKey, open: Callable[[ItemSession], Awaitable[None]]) -> ItemSession:
+        session = ItemSession(key)
+        await open(session)
+        self._sessions[key] = session
+        metrics.ITEM_SESSIONS.inc()
+        return session
+
+    def leave(self, session: ItemSession, subscriber: Subscriber):
+        """Removes a socket from its session, closing the session if it was the last one."""
+        if subscriber in session.subscribers:
+            session.subscribers.remove(subscriber)
+        if not session.subscribers:
+            self._close(session)
+
+    def drop(self, team_id: int, item_id: Optional[str] = None):
+        """Retires a team's sessions (or one item's) after its chat rows were deleted, e.g. by a reset.
+
+        Call it once the deletion is committed: the sockets still attached are
+        told to move, and the fresh session they join is loaded from the DB.
+        """
+        for key, session in list(self._sessions.items()):
+            if key[0] == team_id and (item_id is None or key[1] == item_id):
+                self._close(session)
+                for subscriber in session.subscribers:
+                    subscriber.inbox.put_nowait(SESSION_DROPPED)
+
+    def _close(self, session: ItemSession):
+        if session.closed:
+            return
+        session.closed = True
+        if self._sessions.get(session.key) is session:
+            del self._sessions[session.key]
+            metrics.ITEM_SESSIONS.dec()
+
+    def __len__(self) -> int:
+        return len(self._sessions)
@@ -0,0 +1,52 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable, Tuple
+
+# --- Single-Flight Turns ---
+# Teammates in different browsers often send an item the same question at the
+# same moment. main.py runs each turn under a key of (item session, normalized
+# text, state version): the first socket to ask runs the turn (model call,
+# tags, chat rows, state save) and any socket asking the same thing while it
+# is in flight waits for that turn and gets its result instead of running
+# its own. Keys only live while their turn is in flight; a later repeat is a
+# new turn (or a response-cache hit, see response_cache.py).
+
+
+class SingleFlight:
+    """Concurrent calls with the same key share one execution."""
+
+    def __init__(self):
+        self._calls: Dict[Hashable, asyncio.Future] = {}
+
+    async def do(self, key: Hashable, func: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """Returns (result, shared): `shared` is True if another caller's run produced it.
+
+        An exception from the run is raised to every caller. If the caller
+        running it is cancelled (its socket went away), a waiting caller takes
+        over and runs `func` itself.
+        """
+        while True:
+            future = self._calls.get(key)
+            if future is None:
+                break
+            try:
+                # shield: a waiter going away must not cancel the shared run
+                return await asyncio.shield(future), True
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    raise  # This caller was cancelled, not the run
+
+        future = self._calls[key] = asyncio.get_running_loop().create_future()
+        try:
+            result = await func()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception()  # Retrieved here, so an unshared failure isn't logged twice
+            raise
+        else:
+            future.set_result(result)
+            return result, False
+        finally:
+            del self._calls[key]
@@ -0,0 +1,226 @@
+import secrets
+from collections import namedtuple
+from typing import Dict, List, Optional
+
+from sqlalchemy import select, update
+from sqlalchemy.orm import selectinload
+
+from database import Team
+
+CachedItem = namedtuple("CachedItem", ["name", "icon"])
+
+
+class TeamSnapshot:
+    """A team's game_state and inventory, shaped like the ORM Team for room handlers.
+
+    Snapshots handed out by the cache are private copies: callers may mutate
+    `game_state` (e.g. via award_letter) and hand them back to `save_state`.
+    """
+
+    def __init__(self, id: int, name: str, game_state: dict, inventory: List[CachedItem], completion_time=None, version: int = 0,
+                 db_version: int = 0):
+        self.id = id
+        self.name = name
+        self.game_state = game_state
+        self.inventory = inventory
+        self.completion_time = completion_time
+        self.version = version
+        # teams.state_version this state was read at (for compare-and-set)
+        self.db_version = db_version
+        # State as it was when this copy was taken, used to diff on save
+        self.base_state = dict(game_state)
+
+    def copy(self) -> "TeamSnapshot":
+        return TeamSnapshot(self.id, self.name, dict(self.game_state), list(self.inventory), self.completion_time, self.version,
+                            self.db_version)
+
+    def inventory_names(self) -> List[str]:
+        return [i.name for i in self.inventory]
+
+    def to_dict(self) -> dict:
+        """Full snapshot as sent to clients that are out of date."""
+        return {
+            "game_state": self.game_state,
+            "inventory": [{"name": i.name, "icon": i.icon} for i in self.inventory]
+        }
+
+
+def diff_state(old: dict, new: dict):
+    """Returns (changed, removed): the keys set or altered in `new`, and the keys dropped from `old`."""
+    changed = {k: v for k, v in new.items() if old.get(k, _MISSING) != v}
+    removed = [k for k in old if k not in new]
+    return changed, removed
+
+
+def state_delta(old: TeamSnapshot, new: TeamSnapshot) -> dict:
+    """What a client holding `old` needs to reach `new`; empty if nothing changed."""
+    delta = {}
+    changed, removed = diff_state(old.game_state, new.game_state)
+    if changed:
+        delta["set"] = changed
+    if removed:
+        delta["unset"] = removed
+
+    old_items, new_items = set(old.inventory_names()), set(new.inventory_names())
+    added = [{"name": i.name, "icon": i.icon} for i in new.inventory if i.name not in old_items]
+    if added:
+        delta["inventory_added"] = added
+    dropped = [name for name in old.inventory_names() if name not in new_items]
+    if dropped:
+        delta["inventory_removed"] = dropped
+    return delta
+
+
+class ConcurrentUpdateError(Exception):
+    """save_state kept losing the compare-and-set race on a team's row."""
+
+
+class TeamStateCache:
+    """Process-wide cache of each team's game_state and inventory.
+
+    Every write path in main.py goes through here (or invalidates the entry),
+    so the WebSocket loop can read team state from memory instead of
+    refreshing from SQLite on every turn. Each change bumps the team's
+    version number. Versions start from a random 52-bit base per process
+    (still exact as a JavaScript number), so a client can't mistake another
+    process's or worker's state for the one it already holds.
+
+    With several workers, other processes write the same rows: save_state
+    compares-and-sets teams.state_version, and bus.py tells this cache to
+    drop entries that another worker changed. Bus messages take a moment to
+    arrive, so a `shared` cache also checks the row's state_version (a
+    primary-key lookup) before serving an entry; a turn never starts from
+    state another worker has already replaced.
+
+    `generation` counts writes to any team, for cheap "has anything changed"
+    checks such as the /teams ETag.
+
+    Cached snapshots are never mutated in place, only replaced, so the LLM
+    worker threads can read them without locking.
+    """
+
+    def __init__(self, shared: bool = False):
+        self.shared = shared
+        self._teams: Dict[int, TeamSnapshot] = {}
+        self._versions: Dict[int, int] = {}
+        self._epoch = secrets.randbits(52)
+        self.generation = 0
+
+    def _bump(self, team_id: int) -> int:
+        version = self._versions.get(team_id, self._epoch) + 1
+        self._versions[team_id] = version
+        return version
+
+    def _store(self, snapshot: TeamSnapshot) -> TeamSnapshot:
+        snapshot.version = self._bump(snapshot.id)
+        snapshot.base_state = dict(snapshot.game_state)
+        self._teams[snapshot.id] = snapshot
+        return snapshot.copy()
+
+    async def get(self, db, team_id: int) -> Optional[TeamSnapshot]:
+        """Returns a private copy of the team's snapshot, loading it on a miss."""
+        cached = self._teams.get(team_id)
+        if cached is not None:
+            if not self.shared or await self._current(db, cached):
+                return cached.copy()
+            self._teams.pop(team_id, None)
+
+        # populate_existing: the session may hold an older copy of the row
+        team = await db.scalar(
+            select(Team).options(selectinload(Team.inventory)).where(Team.id == team_id)
+            .execution_options(populate_existing=True)
+        )
+        if team is None:
+            return None
+        return self._store(TeamSnapshot(
+            team.id, team.name, dict(team.game_state),
+            [CachedItem(i.name, i.icon) for i in team.inventory],
+            team.completion_time, db_version=team.state_version
+        ))
+
+    async def _current(self, db, cached: TeamSnapshot) -> bool:
+        """Whether no other worker has written the team's row since `cached` was read."""
+        db_version = await db.scalar(select(Team.state_version).where(Team.id == cached.id))
+        return db_version == cached.db_version
+
+    def peek(self, team_id: int) -> Optional[TeamSnapshot]:
+        """The cached snapshot without loading or copying (read-only, any thread)."""
+        return self._teams.get(team_id)
+
+    def etag(self) -> str:
+        """Changes whenever any team is written (and differs between processes)."""
+        return f'"{self._epoch}.{self.generation}"'
+
+    async def save_state(self, db, snapshot: TeamSnapshot) -> TeamSnapshot:
+        """Writes the keys changed on `snapshot` since it was copied.
+
+        Changes are merged onto the latest cached state rather than replacing
+        it, so two sockets of the same team don't undo each other's updates.
+        The UPDATE only applies if the row is still at the version that state
+        was read at; if another worker got there first, the row is reloaded
+        and the changes merged again. The caller commits.
+        """
+        changed, removed = diff_state(snapshot.base_state, snapshot.game_state)
+        if not changed and not removed:
+            return self._teams[snapshot.id].copy() if snapshot.id in self._teams else snapshot
+
+        for _ in range(MAX_SAVE_ATTEMPTS):
+            # Invalidated mid-turn (e.g. a reset): merge onto what the DB has now
+            latest = self._teams.get(snapshot.id) or await self.get(db, snapshot.id)
+            if latest is None:
+                return snapshot
+            new_state = {k: v for k, v in latest.game_state.items() if k not in removed}
+            new_state.update(changed)
+
+            result = await db.execute(
+                update(Team)
+                .where(Team.id == snapshot.id, Team.state_version == latest.db_version)
+                .values(game_state=new_state, state_version=latest.db_version + 1)
+            )
+            if result.rowcount:
+                break
+            # Another worker wrote the row since it was cached
+            self._teams.pop(snapshot.id, None)
+        else:
+            raise ConcurrentUpdateError(f"Team {snapshot.id} kept changing while saving its state")
+
+        self.generation += 1
+        return self._store(TeamSnapshot(
+            snapshot.id, latest.name, new_state, list(latest.inventory), latest.completion_time,
+            db_version=latest.db_version + 1
+        ))
+
+    def add_item(self, team_id: int, name: str, icon: str, db_version: Optional[int] = None):
+        """Records an inventory item that has already been written to the DB.
+
+        `db_version` is the row's state_version after the write, if it was
+        bumped; when other writes landed in between, the entry is dropped instead.
+        """
+        self.generation += 1
+        cached = self._teams.get(team_id)
+        if cached is None:
+            return
+        if db_version is not None and db_version != cached.db_version + 1:
+            self._teams.pop(team_id, None)
+            self._bump(team_id)
+            return
+        if name in cached.inventory_names() and db_version is None:
+            return
+        updated = cached.copy()
+        if name not in updated.inventory_names():
+            updated.inventory.append(CachedItem(name, icon))
+        if db_version is not None:
+            updated.db_version = db_version
+        self._store(updated)
+
+    def invalidate(self, team_id: int):
+        """Drops a team's entry after a write that bypassed the cache."""
+        self.generation += 1
+        self._teams.pop(team_id, None)
+        self._bump(team_id)
+
+
+_MISSING = object()
+
+# Compare-and-set attempts before save_state gives up
+MAX_SAVE_ATTEMPTS = 5
@@ -0,0 +1,103 @@
+import re
+from typing import List, Tuple
+
+# --- AI Command Tags ---
+# pattern: [STATE_UPDATE: key=value]
+STATE_PATTERN = r"\[STATE_UPDATE:\s*(.+?)\]"
+# pattern: [ADD_ITEM: name="Item Name" icon="💡"]
+ITEM_PATTERN = r'\[ADD_ITEM:\s*name="([^"]+)"\s*icon="([^"]+)"\]'
+
+TAG_PREFIXES = ("[STATE_UPDATE:", "[ADD_ITEM:")
+
+# A '[' that has not closed after this many characters is treated as plain text
+MAX_TAG_LENGTH = 512
+
+
+def parse_state_value(value: str):
+    """Converts the right-hand side of a STATE_UPDATE into a bool, int or string."""
+    if value.lower() == 'true': return True
+    if value.lower() == 'false': return False
+    if value.isdigit(): return int(value)
+    return value
+
+
+def parse_tag(tag_text: str):
+    """Returns ('state', key, value) / ('item', name, icon) for a complete tag, or None.
+
+    A STATE_UPDATE without '=' is still a tag (it gets stripped) but has no key.
+    """
+    match = re.fullmatch(STATE_PATTERN, tag_text)
+    if match:
+        state_str = match.group(1).strip()
+        if "=" not in state_str:
+            return ("state", None, None)
+        key, value = state_str.split("=", 1)
+        return ("state", key.strip(), parse_state_value(value.strip()))
+
+    match = re.fullmatch(ITEM_PATTERN, tag_text)
+    if match:
+        return ("item", match.group(1), match.group(2))
+    return None
+
+
+class StreamingTagParser:
+    """Incrementally strips command tags from streamed model output.
+
+    `feed()` returns the text that is safe to show the player plus any tags that
+    closed in this chunk. Text that could still turn out to be the start of a
+    tag (e.g. a trailing "[STATE_UP") is held back until the next chunk.
+    """
+
+    def __init__(self):
+        self._buffer = ""
+
+    def feed(self, chunk: str) -> Tuple[str, List[tuple]]:
+        self._buffer += chunk
+        return self._drain(final=False)
+
+    def close(self) -> Tuple[str, List[tuple]]:
+        return self._drain(final=True)
+
+    def _drain(self, final: bool) -> Tuple[str, List[tuple]]:
+        text_parts = []
+        tags = []
+        buf = self._buffer
+
+        while buf:
+            start = buf.find("[")
+            if start == -1:
+                text_parts.append(buf)
+                buf = ""
+                break
+
+            text_parts.append(buf[:start])
+            buf = buf[start:]
+
+            prefix = next((p for p in TAG_PREFIXES if buf.startswith(p)), None)
+            if prefix is None:
+                # Could this still become a tag once more text arrives?
+                if not final and any(p.startswith(buf) for p in TAG_PREFIXES):
+                    break
+                text_parts.append("[")
+                buf = buf[1:]
+                continue
+
+            end = buf.find("]")
+            if end == -1:
+                if not final and len(buf) < MAX_TAG_LENGTH:
+                    break
+                text_parts.append(buf[0])
+                buf = buf[1:]
+                continue
+
+            tag = parse_tag(buf[:end + 1])
+            if tag is None:
+                text_parts.append(buf[0])
+                buf = buf[1:]
+                continue
+
+            tags.append(tag)
+            buf = buf[end + 1:]
+
+        self._buffer = buf
+        return "".join(text_parts), tags
@@ -0,0 +1,61 @@
+import re
+from typing import Iterable, Optional
+
+# --- Declarative Puzzle Transitions ---
+# An item in ROOM_CONFIG can list the deterministic steps of its puzzle under
+# "transitions". Each rule is a dict:
+#   "when":          {state_key: value or [values]}; None stands for "not set yet"
+#   "match":         regex searched (case-insensitively) in the player's message
+#   "requires_item": inventory item the team must hold (optional)
+#   "lacks_item":    inventory item the team must NOT hold (optional)
+#   "response":      canned reply; may contain [STATE_UPDATE]/[ADD_ITEM] tags
+# The first rule that applies answers the turn without calling the model.
+#
+# "follow_ups" maps a state key to {new value: text}. When a reply (canned or
+# from the model) sets that key, the text is appended to it. Templates are
+# formatted with the team's game_state.
+
+
+def state_matches(game_state: dict, when: dict) -> bool:
+    for key, expected in when.items():
+        allowed = expected if isinstance(expected, list) else [expected]
+        if game_state.get(key) not in allowed:
+            return False
+    return True
+
+
+def find_transition(rules: Iterable[dict], team, user_text: str) -> Optional[dict]:
+    """Returns the first rule that applies to this message, or None to ask the model."""
+    inventory = None
+    for rule in rules:
+        if not state_matches(team.game_state, rule.get("when", {})):
+            continue
+        if "requires_item" in rule or "lacks_item" in rule:
+            if inventory is None:
+                inventory = {i.name for i in team.inventory}
+            if "requires_item" in rule and rule["requires_item"] not in inventory:
+                continue
+            if "lacks_item" in rule and rule["lacks_item"] in inventory:
+                continue
+        if not re.search(rule["match"], user_text, re.IGNORECASE):
+            continue
+        return rule
+    return None
+
+
+def render_follow_ups(item_conf: dict, updates: dict, team) -> str:
+    """Follow-up text for the state changes in `updates`, or "" if the item declares none."""
+    parts = []
+    for key, by_value in item_conf.get("follow_ups", {}).items():
+        if key in updates and updates[key] in by_value:
+            parts.append(by_value[updates[key]].format_map(team.game_state))
+    return "\n\n".join(parts)
+
+
+def public_room_config(room_conf: dict) -> dict:
+    """ROOM_CONFIG as served to the browser: transitions (i.e. the answers) are left out."""
+    items = {
+        item_id: {k: v for k, v in item_conf.items() if k not in ("transitions", "follow_ups")}
+        for item_id, item_conf in room_conf.get("items", {}).items()
+    }
+    return {**room_conf, "items": items} if "items" in room_conf else room_conf